@@ -1,9 +1,22 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 from mousse_api.logger import logger
 from mousse_api._version import __version__
-from .router import records, country, ner, clustered
+from .router import records, country, ner, clustered, metrics
+from .utils.inference import close_embedding_client
+from .utils.llm import get_http_client, close_http_client
+from mousse_api.valkey_client import close_valkey_client
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_http_client()
+    yield
+    logger.info("Closing long-lived clients")
+    await close_embedding_client()
+    await close_http_client()
+    await close_valkey_client()
 
 logger.info("Creating FastAPI app")
 app = FastAPI(
@@ -11,9 +24,11 @@ app = FastAPI(
     description="Mousse API",
     version=__version__,
     root_path=os.getenv('ROOT_PATH', '') + '/api',
+    lifespan=lifespan,
 )
 
 app.include_router(records.router)
 app.include_router(country.router)
 app.include_router(ner.router)
 app.include_router(clustered.router)
+app.include_router(metrics.router)
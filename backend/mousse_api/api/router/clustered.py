@@ -1,76 +1,367 @@
+import os
 import json
+import asyncio
 import numpy as np
-from fastapi import APIRouter, Depends, Path, Request
+from uuid import uuid4
+from fastapi import APIRouter, Depends, Path, Request, HTTPException
+from fastapi.responses import StreamingResponse
 from sqlalchemy import text, bindparam
-from pgvector.sqlalchemy import Vector
+from mousse_api.db.types import Vector
 from sqlalchemy.ext.asyncio import AsyncSession
 from dataclasses import asdict
+from valkey.exceptions import ValkeyError
 
 from mousse_api.db import get_session
-from mousse_api.api.schemata.clusters import ClusterResponse, ClusterSearchBody, MemberClusterSearchBody
+from mousse_api.db.models import LowerDim
+from mousse_api.logger import logger
+from mousse_api.api.schemata.clusters import ClusterResponse, ClusterSearchBody, MemberClusterSearchBody, ClusterJobResponse, ClusterJobStatus
 from mousse_api.api.schemata.records import SearchGeoJSONResponse, SearchJSONResponse
 from mousse_api.api.utils.vector_search_sql import SqlConstuctor
-from mousse_api.api.utils.inference import inference
+from mousse_api.api.utils.inference import embed_query
 from mousse_api.api.utils.helpers import epoch_to_months
-from mousse_api.api.utils.cluster import ClusterClassifier
-from mousse_api.api.utils.cache import cache_clustered_results, get_cached_clusters
+from mousse_api.api.utils.country import get_country_geometry
+from mousse_api.api.utils.topic import get_topic_ids
+from mousse_api.api.utils.cluster import Cluster, ClusterClassifier, SUMMARY_TIMEOUT
+from mousse_api.api.utils.cache import (
+    cache_clustered_results, get_cached_clusters, get_cached_cluster_members, refresh_clustered_results,
+    generate_clusters_key, update_cluster_summaries, cache_job, get_cached_job,
+)
+from mousse_api.api.utils.singleflight import SingleFlight
 from mousse_api.valkey_client import get_valkey_client
-from mousse_api.api.utils.inference import inference
 
 router = APIRouter(
     tags=["Clusters"],
     prefix="/clustered",
 )
 
-valkey = get_valkey_client()
-
-async def _get_clusters(body: ClusterSearchBody, session: AsyncSession, request: Request):
-    clusters = get_cached_clusters(valkey, body)
-    if not clusters:
-        sql = SqlConstuctor(threshold=0.45, results_per_page=1000)
-        if body.features is not None and len(body.features) > 0:
-            sql.add('spatial', body.features)
-        elif body.country is not None and len(body.country) > 0:
-            sql.add('country', body.country)
-        if body.dateRange is not None and (body.dateRange.start or body.dateRange.end):
-            start_date = body.dateRange.start.isoformat() if body.dateRange.start is not None else '0001-01-01'
-            end_date = body.dateRange.end.isoformat() if body.dateRange.end is not None else '9999-12-31'
-            sql.add('daterange', start_date, end_date)
-        if body.epoch is not None and len(body.epoch) > 0:
-            months = epoch_to_months(body.epoch)
-            sql.add('epoch', months)
-
-        embedding = inference([body.query])
-
-        stmt = sql.create_clustering(embedding[0].tolist())
-
-        results = await session.execute(stmt)
-
-        data = [dict(row) for row in results.mappings()]
-        text_ids = [str(r['uuid']) for r in data]
-        texts = [r['title'] for r in data]
-        projections = np.array([json.loads(r['vector']) for r in data])
-        scores = [float(r['score']) for r in data]
-        classifier = ClusterClassifier(texts=texts, text_ids=text_ids, projections=projections, request=request, scores=scores)
-
-        clusters = await classifier.fit(n_clusters=body.numberOfClusters)
-        clusters = [asdict(cluster) for cluster in clusters]
-    cache_clustered_results(valkey, query_body=body, clustered_result=clusters)
+CLUSTERS_CACHE_TTL = int(os.getenv("CLUSTERS_CACHE_TTL", 300))
+CLUSTERS_LOCK_TTL = float(os.getenv("CLUSTERS_LOCK_TTL", 120))
+CLUSTER_SUMMARY_WAIT = float(os.getenv("CLUSTER_SUMMARY_WAIT", 10))
+CLUSTER_MEMORY_BUDGET = int(os.getenv("CLUSTER_MEMORY_BUDGET", 64 * 1024 * 1024))
+CLUSTER_FETCH_SIZE = int(os.getenv("CLUSTER_FETCH_SIZE", 2000))
+# Estimated memory (in bytes) held by a clustered record besides its projection: its uuid, title and score
+# (~300), its `ClusterElement` (~100) and the dict it is converted to (~200), and the labels and sort keys
+CLUSTER_ROW_OVERHEAD = 1024
+
+CLUSTER_JOB_TTL = int(os.getenv("CLUSTER_JOB_TTL", 900))
+CLUSTER_JOB_POLL = 0.5
+# Time (in seconds) after which a job stops waiting for the summaries still missing, e.g. if their batch failed
+CLUSTER_JOB_SUMMARY_WAIT = float(os.getenv("CLUSTER_JOB_SUMMARY_WAIT", 2 * SUMMARY_TIMEOUT))
+CLUSTER_MAX_JOBS = int(os.getenv("CLUSTER_MAX_JOBS", 8))
+
+# Keeps a reference to the running summary tasks and jobs, so that they are not garbage collected
+_summary_tasks: set[asyncio.Task] = set()
+_job_tasks: set[asyncio.Task] = set()
+# Bounds the number of jobs running in the background of the worker
+_job_slots = asyncio.Semaphore(CLUSTER_MAX_JOBS)
+
+clusters_flight = SingleFlight("clusters", lock_ttl=CLUSTERS_LOCK_TTL, poll_interval=0.2)
+
+async def _fill_late_summaries(body: ClusterSearchBody, classifier: ClusterClassifier) -> dict[str, str]:
+    async def fill(summaries: dict[str, str]) -> None:
+        try:
+            await update_cluster_summaries(get_valkey_client(), body, summaries)
+        except ValkeyError as e:
+            logger.warning("Could not write late cluster summaries to cache: %s", e)
+
+    return await classifier.late_summaries(fill)
+
+def _start_late_summaries(body: ClusterSearchBody, classifier: ClusterClassifier) -> asyncio.Task:
+    """
+    Fills the late summaries of freshly computed clusters into the cache, batch by batch, in the background.
+
+    As the summaries are only written into clusters that are still cached, this should be called
+    once the clusters have been written to the cache.
+    """
+    task = asyncio.create_task(_fill_late_summaries(body, classifier))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+    return task
+
+def _max_clustered_results(body: ClusterSearchBody) -> int:
+    """Returns the number of results to cluster, within the memory budget."""
+    row_size = LowerDim.vector.type.dim * np.dtype(np.float32).itemsize + CLUSTER_ROW_OVERHEAD
+    return max(1, min(body.maxResults, CLUSTER_MEMORY_BUDGET // row_size))
+
+async def _fetch_projections(session: AsyncSession, stmt, capacity: int) -> tuple[list[str], list[str], list[float], np.ndarray]:
+    """
+    Streams the records to cluster from a server-side cursor, `CLUSTER_FETCH_SIZE` rows at a time.
+
+    The projections, read as NumPy arrays by the binary codec of pgvector, are stacked batch by
+    batch into a preallocated float32 array, so that only one batch of rows is held at any time.
+
+    Args:
+        capacity (int): The maximum number of rows returned by the statement.
+
+    Returns:
+        tuple: The uuids, titles and scores of the records, and their projections.
+    """
+    dim = LowerDim.vector.type.dim
+    projections = np.empty((capacity, dim), dtype=np.float32)
+    text_ids, texts, scores = [], [], []
+    result = await session.stream(stmt.execution_options(yield_per=CLUSTER_FETCH_SIZE))
+    async for partition in result.partitions():
+        start = len(text_ids)
+        np.stack([row.vector for row in partition], out=projections[start:start + len(partition)])
+        text_ids.extend(str(row.uuid) for row in partition)
+        texts.extend(row.title for row in partition)
+        scores.extend(float(row.score) for row in partition)
+    return text_ids, texts, scores, projections[:len(text_ids)]
+
+def _clusters_as_dicts(clusters: list[Cluster]) -> list[dict]:
+    return [asdict(cluster) | {'element_count': len(cluster.elements)} for cluster in clusters]
+
+async def _compute_clusters(
+    body: ClusterSearchBody,
+    session: AsyncSession,
+    summary_wait: float = CLUSTER_SUMMARY_WAIT,
+) -> tuple[list[dict], ClusterClassifier]:
+    """
+    Clusters the results of a query and summarizes the clusters.
+
+    The summaries are awaited for at most `summary_wait` seconds; the late ones keep being generated
+    and should be filled in with `_start_late_summaries`, once the clusters are cached.
+
+    Returns:
+        tuple[list[dict], ClusterClassifier]: The clusters, and the classifier generating their late summaries.
+    """
+    max_results = _max_clustered_results(body)
+    sql = SqlConstuctor(threshold=0.45, results_per_page=max_results)
+    if body.features is not None and len(body.features) > 0:
+        sql.add('spatial', body.features)
+    elif body.country is not None and len(body.country) > 0:
+        sql.add('country', body.country, await get_country_geometry(session, body.country))
+    if body.dateRange is not None and (body.dateRange.start or body.dateRange.end):
+        start_date = body.dateRange.start.isoformat() if body.dateRange.start is not None else '0001-01-01'
+        end_date = body.dateRange.end.isoformat() if body.dateRange.end is not None else '9999-12-31'
+        sql.add('daterange', start_date, end_date)
+    if body.epoch is not None and len(body.epoch) > 0:
+        months = epoch_to_months(body.epoch)
+        sql.add('epoch', months)
+    if body.topic is not None and len(body.topic) > 0:
+        sql.add('topic', await get_topic_ids(session, body.topic))
+
+    await sql.choose_strategy(session)
+    embedding = await embed_query(body.query)
+
+    stmt = sql.create_clustering(embedding.tolist())
+
+    # The search returns one more result than `results_per_page`
+    text_ids, texts, scores, projections = await _fetch_projections(session, stmt, max_results + 1)
+    # The summaries may outlive the request, so they are not bound to its client
+    classifier = ClusterClassifier(texts=texts, text_ids=text_ids, projections=projections, request=None, scores=scores)
+
+    clusters = await classifier.fit(n_clusters=body.numberOfClusters, summary_wait=summary_wait)
+    return await asyncio.to_thread(_clusters_as_dicts, clusters), classifier
+
+async def _compute_and_cache_clusters(body: ClusterSearchBody, summary_wait: float = CLUSTER_SUMMARY_WAIT) -> list[dict]:
+    """
+    Computes the clusters of a query and writes them to the cache.
+
+    The computation is shared by all the callers and outlives a cancelled one, so it runs in a session of its own.
+    """
+    async for session in get_session():
+        clusters, classifier = await _compute_clusters(body, session, summary_wait=summary_wait)
+    try:
+        await cache_clustered_results(get_valkey_client(), query_body=body, clustered_result=clusters, ttl_seconds=CLUSTERS_CACHE_TTL)
+    except ValkeyError as e:
+        logger.warning("Could not write clusters to cache: %s", e)
+    else:
+        _start_late_summaries(body, classifier)
     return clusters
 
-@router.post('/search', summary="Clustered Search", description="Get clustered search results based on the given query.", response_model=list[ClusterResponse])
-async def clustered_search(request: Request, body: ClusterSearchBody, session: AsyncSession = Depends(get_session)):
-    clusters = await _get_clusters(body, session, request)
+async def _read_cached_clusters(body: ClusterSearchBody) -> list[dict] | None:
+    try:
+        return await get_cached_clusters(get_valkey_client(), body)
+    except ValkeyError as e:
+        logger.warning("Could not read clusters from cache: %s", e)
+        return None
+
+async def _get_clusters(body: ClusterSearchBody) -> list[dict]:
+    """
+    Returns the clusters of a query, going through the cache.
 
-    clusters_reduced = [ClusterResponse(
+    A cache hit only extends the expiration of the cached clusters. On a miss, the clusters are
+    computed once for all the concurrent requests for the same query, even across workers, instead
+    of clustering and summarizing again.
+
+    Clusters read from the cache only carry their `element_count`; their members should be read
+    with `_get_cluster_members`. Freshly computed clusters also carry their `elements`.
+    """
+    valkey = get_valkey_client()
+    clusters = await _read_cached_clusters(body)
+    if clusters:
+        try:
+            await refresh_clustered_results(valkey, body, [c['id'] for c in clusters], ttl_seconds=CLUSTERS_CACHE_TTL)
+        except ValkeyError as e:
+            logger.warning("Could not refresh cached clusters: %s", e)
+        return clusters
+
+    return await clusters_flight.do(
+        generate_clusters_key(body), lambda: _compute_and_cache_clusters(body), load=lambda: _read_cached_clusters(body)
+    )
+
+async def _get_cluster_members(body: ClusterSearchBody, cluster: dict, start: int, stop: int) -> list[tuple[str, float]]:
+    """
+    Returns the uuids and scores of the members of a cluster, from index `start` (inclusive) to `stop` (exclusive).
+
+    Only the requested members are read from the cache. If they are no longer cached, the clusters are
+    recomputed (once for the concurrent requests of the worker) and cached again.
+    """
+    if 'elements' not in cluster:
+        expected = max(min(stop, cluster['element_count']) - start, 0)
+        try:
+            members = await get_cached_cluster_members(get_valkey_client(), body, cluster['id'], start, stop)
+            if len(members) == expected:
+                return members
+        except ValkeyError as e:
+            logger.warning("Could not read cluster members from cache: %s", e)
+        # Not coalesced with `_get_clusters`, which may return the cached summary without the members
+        clusters = await clusters_flight.do(f"{generate_clusters_key(body)}:members", lambda: _compute_and_cache_clusters(body))
+        cluster = next((c for c in clusters if c['id'] == cluster['id']), {'elements': []})
+    return [(member['text_id'], member['score']) for member in cluster['elements'][start:stop]]
+
+def _reduce_cluster(cluster: dict) -> ClusterResponse:
+    return ClusterResponse(
         id=cluster['id'],
         representativeTitle=cluster['representative_text'],
         summary=cluster['summary'],
-        elementCount=len(cluster['elements'])
-    ) for cluster in clusters]
+        elementCount=cluster['element_count']
+    )
+
+async def _publish_job(job_id: str, status: ClusterJobStatus, clusters: list[dict] | None = None, error: str | None = None) -> None:
+    state = ClusterJobResponse(
+        jobId=job_id,
+        status=status,
+        clusters=[_reduce_cluster(cluster) for cluster in clusters] if clusters is not None else None,
+        error=error,
+    )
+    await cache_job(get_valkey_client(), job_id, state.model_dump(mode='json'), ttl_seconds=CLUSTER_JOB_TTL)
+
+async def _publish_failure(job_id: str, error: str) -> None:
+    try:
+        await _publish_job(job_id, ClusterJobStatus.failed, error=error)
+    except ValkeyError as e:
+        logger.warning("Could not publish the failure of job %s: %s", job_id, e)
+
+async def _run_job(job_id: str, body: ClusterSearchBody) -> None:
+    """
+    Runs a clustered search in the background, publishing its progress in Valkey.
+
+    The clusters are computed once for the jobs and requests of the same query, through `clusters_flight`
+    (without waiting for the summaries, if the job starts the computation). They are published as soon as
+    they are available, published again whenever the cache gets new summaries, and marked completed once
+    all of them are there, or after `CLUSTER_JOB_SUMMARY_WAIT` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        clusters = await _read_cached_clusters(body)
+        if not clusters:
+            clusters = await clusters_flight.do(
+                generate_clusters_key(body),
+                lambda: _compute_and_cache_clusters(body, summary_wait=0),
+                load=lambda: _read_cached_clusters(body),
+            )
+
+        published = None
+        deadline = loop.time() + CLUSTER_JOB_SUMMARY_WAIT
+        while any(cluster['summary'] is None for cluster in clusters) and loop.time() < deadline:
+            summaries = [cluster['summary'] for cluster in clusters]
+            if summaries != published:
+                await _publish_job(job_id, ClusterJobStatus.clustered, clusters)
+                published = summaries
+            await asyncio.sleep(CLUSTER_JOB_POLL)
+            clusters = await _read_cached_clusters(body) or clusters
+        await _publish_job(job_id, ClusterJobStatus.completed, clusters)
+    except asyncio.CancelledError:
+        await _publish_failure(job_id, "The job was cancelled")
+        raise
+    except Exception as e:
+        logger.exception("Clustered search job %s failed", job_id)
+        await _publish_failure(job_id, str(e) or type(e).__name__)
+
+async def _read_job(job_id: str) -> dict:
+    try:
+        state = await get_cached_job(get_valkey_client(), job_id)
+    except ValkeyError as e:
+        raise HTTPException(status_code=503, detail=f"Job state unavailable: {e}")
+    if state is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return state
+
+@router.post('/search', summary="Clustered Search", description="Get clustered search results based on the given query.", response_model=list[ClusterResponse])
+async def clustered_search(request: Request, body: ClusterSearchBody):
+    clusters = await _get_clusters(body)
+
+    clusters_reduced = [_reduce_cluster(cluster) for cluster in clusters]
 
     return clusters_reduced
 
+@router.post(
+    '/jobs',
+    summary="Asynchronous Clustered Search",
+    description="""
+Starts a clustered search in the background and returns its job id at once.
+
+The state of the job can be polled at `/clustered/jobs/{job_id}`, or followed as Server-Sent Events at
+`/clustered/jobs/{job_id}/events`. The clusters are available as soon as they are formed (`clustered`
+status), and their summaries are filled in once generated (`completed` status). Any worker can serve
+the state of any job.
+
+A worker runs a limited number of jobs at once; beyond it, new jobs are rejected with a 429 status.
+    """,
+    response_model=ClusterJobResponse,
+    status_code=202,
+)
+async def clustered_job(body: ClusterSearchBody):
+    if _job_slots.locked():
+        raise HTTPException(status_code=429, detail="Too many clustered search jobs in progress, retry later")
+    await _job_slots.acquire()
+
+    job_id = uuid4().hex
+    try:
+        await _publish_job(job_id, ClusterJobStatus.pending)
+    except ValkeyError as e:
+        _job_slots.release()
+        raise HTTPException(status_code=503, detail=f"Job state unavailable: {e}")
+    except asyncio.CancelledError:
+        _job_slots.release()
+        raise
+
+    task = asyncio.create_task(_run_job(job_id, body))
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+    task.add_done_callback(lambda _: _job_slots.release())
+
+    return ClusterJobResponse(jobId=job_id, status=ClusterJobStatus.pending)
+
+@router.get('/jobs/{job_id}', summary="Clustered Search Job", description="Get the state of an asynchronous clustered search.", response_model=ClusterJobResponse)
+async def clustered_job_state(job_id: str = Path(..., description="Job id")):
+    return await _read_job(job_id)
+
+@router.get('/jobs/{job_id}/events', summary="Clustered Search Job Events", description="Follow the state of an asynchronous clustered search as Server-Sent Events, one per status change.")
+async def clustered_job_events(request: Request, job_id: str = Path(..., description="Job id")):
+    state = await _read_job(job_id)
+
+    async def events():
+        nonlocal state
+        previous = None
+        while True:
+            if state != previous:
+                yield f"event: {state['status']}\ndata: {json.dumps(state)}\n\n"
+                previous = state
+            if state['status'] in (ClusterJobStatus.completed, ClusterJobStatus.failed):
+                return
+            await asyncio.sleep(CLUSTER_JOB_POLL)
+            if await request.is_disconnected():
+                return
+            try:
+                state = await get_cached_job(get_valkey_client(), job_id) or previous
+            except ValkeyError as e:
+                logger.warning("Could not read job state: %s", e)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @router.post('/members/cluster/{cluster_id}', summary="Clustered Members", description="Get clustered members based on the given cluster ID.", response_model=SearchJSONResponse | SearchGeoJSONResponse)
 async def clustered_members(request: Request, body: MemberClusterSearchBody, cluster_id: int = Path(..., description="Cluster id", example=1), session: AsyncSession = Depends(get_session)):
     query_body: ClusterSearchBody = ClusterSearchBody(
@@ -79,9 +370,11 @@ async def clustered_members(request: Request, body: MemberClusterSearchBody, clu
         features=body.features,
         dateRange=body.dateRange,
         epoch=body.epoch,
-        numberOfClusters=body.numberOfClusters
+        topic=body.topic,
+        numberOfClusters=body.numberOfClusters,
+        maxResults=body.maxResults
     )
-    clusters = await _get_clusters(query_body, session, request)
+    clusters = await _get_clusters(query_body)
     cluster = next((c for c in clusters if c['id'] == cluster_id), None)
 
     if not cluster:
@@ -89,7 +382,7 @@ async def clustered_members(request: Request, body: MemberClusterSearchBody, clu
     
     start_idx = (body.page - 1) * body.resultsPerPage
     end_idx = start_idx + body.resultsPerPage
-    cluster_members = [member['text_id'] for member in cluster['elements'][start_idx:end_idx]]
+    cluster_members = [uuid for uuid, _ in await _get_cluster_members(query_body, cluster, start_idx, end_idx)]
     if len(cluster_members) == 0:
         return dict(
             page=body.page,
@@ -123,7 +416,7 @@ async def clustered_members(request: Request, body: MemberClusterSearchBody, clu
         FROM records
         WHERE uuid IN ({', '.join(f"'{member}'" for member in cluster_members)})
     """
-    embedding = inference([body.query])[0].tolist()
+    embedding = (await embed_query(body.query)).tolist()
     results = await session.execute(text(stmt).bindparams(
         bindparam("embedding", value=embedding, type_=Vector)
     ))
@@ -137,7 +430,7 @@ async def clustered_members(request: Request, body: MemberClusterSearchBody, clu
     
     response = dict(
         page=body.page,
-        hasMore=len(cluster['elements']) > end_idx,
+        hasMore=cluster['element_count'] > end_idx,
         data=data
     )
 
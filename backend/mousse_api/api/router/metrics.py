@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+
+from mousse_api.api.utils.metrics import snapshot
+
+router = APIRouter(
+    tags=["Monitoring"],
+    prefix="/metrics",
+)
+
+@router.get(
+    '',
+    summary="Service metrics",
+    description=(
+        "Returns the in-process metrics (counters and summaries) of the worker that served the request. "
+        "Each worker keeps its own metrics, identified by the `pid` attribute."
+    ),
+)
+async def metrics():
+    return snapshot()
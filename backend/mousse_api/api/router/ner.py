@@ -1,15 +1,23 @@
+import os
+import hashlib
 from datetime import date
+from functools import lru_cache
 from fastapi import APIRouter, HTTPException, Depends, Request, Query
-from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from valkey.exceptions import ValkeyError
 
 from mousse_api.db import get_session
-from mousse_api.db.models import Countries
+from mousse_api.logger import logger
+from mousse_api.valkey_client import get_valkey_client
 
 from mousse_api.api.schemata.ner import NERAnalysisResponse, LLMResponse, Entities, TimeRange
 
 from mousse_api.api.utils.prompts import NER_PROMPT
 from mousse_api.api.utils.llm import llm_request, LLMException
+from mousse_api.api.utils.cache import normalize_query, generate_ner_key, cache_ner_result, get_cached_ner_result
+from mousse_api.api.utils.country import get_country_codes
+from mousse_api.api.utils.singleflight import SingleFlight
+from mousse_api.api.utils import metrics
 
 def summarize_schema(schema):
     props= [f"{key}: {item['description']}" for key, item in schema['properties'].items()]
@@ -39,7 +47,69 @@ router = APIRouter(
     prefix="/ner"
 )
 
-system_prompt = NER_PROMPT % {"today": str(date.today()), "schema": summarize_schema(LLMResponse.model_json_schema())}
+NER_SCHEMA = summarize_schema(LLMResponse.model_json_schema())
+# Fingerprint of the prompt template, identifying the prompt in caches and metrics
+NER_PROMPT_VERSION = hashlib.sha256("\0".join([NER_PROMPT, NER_SCHEMA]).encode()).hexdigest()[:12]
+
+completions_metric = metrics.counter(f"ner_completions_{NER_PROMPT_VERSION}", f"Number of NER completions with prompt version {NER_PROMPT_VERSION}")
+
+@lru_cache(maxsize=2)
+def render_system_prompt(today: date) -> str:
+    """
+    Renders the NER system prompt for the given day, which is the reference for relative dates.
+
+    Args:
+        today (date): The current date.
+
+    Returns:
+        str: The system prompt.
+    """
+    return NER_PROMPT % {"today": str(today), "schema": NER_SCHEMA}
+
+NER_CACHE_TTL = int(os.getenv("NER_CACHE_TTL", 86400))
+
+ner_flight = SingleFlight("ner", lock_ttl=30)
+
+async def _read_ner_result(key: str) -> LLMResponse | None:
+    try:
+        cached = await get_cached_ner_result(get_valkey_client(), key)
+    except ValkeyError as e:
+        logger.warning("Could not read NER result from cache: %s", e)
+        return None
+    return LLMResponse.model_validate_json(cached) if cached else None
+
+async def _analyze(query: str) -> LLMResponse:
+    """
+    Extracts the entities of a (normalized) query, going through the cache.
+
+    The results are cached per day, as relative dates (e.g. "last summer") are resolved against
+    the current date. Identical queries in flight share one completion, which is not bound to
+    the client of any of them.
+    """
+    today = date.today()
+    key = generate_ner_key(query, NER_PROMPT_VERSION, os.getenv('LLM_MODEL', ''), today)
+    llm_result = await _read_ner_result(key)
+    if llm_result is not None:
+        return llm_result
+
+    async def complete() -> LLMResponse:
+        completions_metric.inc()
+        llm_result = await llm_request(
+            query=query,
+            system_prompt=render_system_prompt(today),
+            request=None,
+            PydanticModel=LLMResponse,
+            max_requests=3,
+            max_tokens=384,
+            stream=True,
+        )
+        try:
+            await cache_ner_result(get_valkey_client(), key, llm_result, ttl_seconds=NER_CACHE_TTL)
+        except ValkeyError as e:
+            logger.warning("Could not write NER result to cache: %s", e)
+        return llm_result
+
+    return await ner_flight.do(key, complete, load=lambda: _read_ner_result(key))
 
 @router.get(
     '/analyze',
@@ -67,23 +137,14 @@ the core query text. The endpoint returns structured information for downstream
 async def ner(request: Request, query: str = Query(..., description="Input text for analysis"), session: AsyncSession = Depends(get_session)):
 
     try:
-        llm_result = await llm_request(
-            query=query,
-            system_prompt=system_prompt,
-            request=request,
-            PydanticModel=LLMResponse,
-            max_requests=3,
-            max_tokens=384,
-        )
+        llm_result = await _analyze(normalize_query(query))
     except LLMException as e:
         raise HTTPException(status_code=e.status_code, detail=e.detail)
     
     countries = []
     if llm_result.country is not None:
-        sql_query = select(Countries.code, Countries.label)\
-            .where(Countries.label.in_(llm_result.country))
-        query_result = await session.execute(sql_query)
-        countries = [{'code': country[0], 'label': country[1]} for country in query_result.all()]
+        country_codes = await get_country_codes(session)
+        countries = [{'code': country_codes[label], 'label': label} for label in dict.fromkeys(llm_result.country) if label in country_codes]
     
     timerange = TimeRange(
         start=llm_result.periodStart.isoformat() if llm_result.periodStart is not None else None,
@@ -1,21 +1,39 @@
+import os
 import json
+import asyncio
 from fastapi import APIRouter, Depends, Query, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from uuid import UUID
+from valkey.exceptions import ValkeyError
 
 from mousse_api.db import get_session
+from mousse_api.logger import logger
+from mousse_api.valkey_client import get_valkey_client
 from mousse_api.db.models import RawRecord
 from mousse_api.api.schemata.records import SearchBody, SearchJSONResponse, SearchGeoJSONResponse, RecordDetails
 from mousse_api.api.utils.vector_search_sql import SqlConstuctor
-from mousse_api.api.utils.inference import inference
+from mousse_api.api.utils.inference import embed_query
 from mousse_api.api.utils.helpers import epoch_to_months
+from mousse_api.api.utils.country import get_country_geometry
+from mousse_api.api.utils.topic import get_topic_ids
+from mousse_api.api.utils.pagination import search_fingerprint, encode_cursor, decode_cursor
+from mousse_api.api.utils.cache import generate_results_key, cache_result_window, get_cached_result_window
+from mousse_api.api.utils.singleflight import SingleFlight
 
 router = APIRouter(
     tags=["Records"],
     prefix="/records",
 )
 
+RESULT_WINDOW_SIZE = int(os.getenv("RESULT_WINDOW_SIZE", 100))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 300))
+
+# Keeps a reference to the running prefetch tasks, so that they are not garbage collected
+_prefetch_tasks: set[asyncio.Task] = set()
+
+search_flight = SingleFlight("search", lock_ttl=30)
+
 async def _get_record_by_uuid(uuid: UUID, session: AsyncSession) -> dict | None:
     stmt = select(
         RawRecord.metadata_
@@ -25,6 +43,115 @@ async def _get_record_by_uuid(uuid: UUID, session: AsyncSession) -> dict | None:
     record = result.first()
     return record
 
+async def _add_filters(sql: SqlConstuctor, body: SearchBody, session: AsyncSession) -> None:
+    if body.features is not None and len(body.features) > 0:
+        sql.add('spatial', body.features)
+    elif body.country is not None and len(body.country) > 0:
+        sql.add('country', body.country, await get_country_geometry(session, body.country))
+    if body.dateRange is not None and (body.dateRange.start or body.dateRange.end):
+        start_date = body.dateRange.start.isoformat() if body.dateRange.start is not None else '0001-01-01'
+        end_date = body.dateRange.end.isoformat() if body.dateRange.end is not None else '9999-12-31'
+        sql.add('daterange', start_date, end_date)
+    if body.epoch is not None and len(body.epoch) > 0:
+        months = epoch_to_months(body.epoch)
+        sql.add('epoch', months)
+    if body.topic is not None and len(body.topic) > 0:
+        sql.add('topic', await get_topic_ids(session, body.topic))
+
+async def _rank_window(body: SearchBody, window: int, after: tuple[float, str] | None, session: AsyncSession) -> tuple[list[tuple[str, float]], bool]:
+    """
+    Ranks the records of a window of the search results.
+
+    When the last result of the previous window is known, the window is fetched with keyset pagination,
+    otherwise the previous windows are skipped.
+    """
+    sql = SqlConstuctor(page=window + 1, results_per_page=RESULT_WINDOW_SIZE, threshold=body.threshold, after=after)
+    await _add_filters(sql, body, session)
+    await sql.choose_strategy(session)
+    embedding = await embed_query(body.query)
+
+    results = await session.execute(sql.create_ranking(embedding.tolist()))
+    ranked = [(str(row.record_uuid), row.distance) for row in results]
+    return ranked[:RESULT_WINDOW_SIZE], len(ranked) > RESULT_WINDOW_SIZE
+
+async def _read_window(key: str) -> tuple[list[tuple[str, float]], bool] | None:
+    try:
+        return await get_cached_result_window(get_valkey_client(), key)
+    except ValkeyError as e:
+        logger.warning("Could not read results window from cache: %s", e)
+        return None
+
+async def _get_window(body: SearchBody, fingerprint: str, window: int, after: tuple[float, str] | None) -> tuple[list[tuple[str, float]], bool]:
+    """
+    Returns the ranking of a window of the search results, going through the Valkey cache.
+    Identical windows requested concurrently are ranked once. Cache failures are logged and never fail the request.
+
+    The ranking is shared by all the callers and outlives a cancelled one, so it runs in a session of its own.
+    """
+    key = generate_results_key(fingerprint, window)
+    cached = await _read_window(key)
+    if cached is not None:
+        return cached
+
+    async def rank() -> tuple[list[tuple[str, float]], bool]:
+        async for session in get_session():
+            ranked, has_more = await _rank_window(body, window, after, session)
+        try:
+            await cache_result_window(get_valkey_client(), key, ranked, has_more, ttl_seconds=RESULT_CACHE_TTL)
+        except ValkeyError as e:
+            logger.warning("Could not write results window to cache: %s", e)
+        return ranked, has_more
+
+    return await search_flight.do(key, rank, load=lambda: _read_window(key))
+
+async def _prefetch_window(body: SearchBody, fingerprint: str, window: int, after: tuple[float, str]) -> None:
+    try:
+        await _get_window(body, fingerprint, window, after)
+    except Exception as e:
+        logger.warning("Could not prefetch results window %d: %s", window, e)
+
+async def _get_ranked(body: SearchBody, fingerprint: str, offset: int, count: int, after: tuple[float, str] | None) -> list[tuple[str, float]]:
+    """
+    Returns the uuids and distances of (at most) `count` results, starting from rank `offset`.
+
+    The results are ranked in windows of `RESULT_WINDOW_SIZE`, cached in Valkey. The window following
+    the last one used is prefetched in the background, so that paging forward only needs a hydrate query.
+
+    As the windows are shared by all the clients, `after` (which comes from the client) is only used to
+    rank a window if it is the last result of the cached previous window, otherwise the window is ranked
+    by skipping the previous ones.
+
+    Args:
+        body (SearchBody): The search request.
+        fingerprint (str): The fingerprint of the search.
+        offset (int): The rank of the first result.
+        count (int): The number of results.
+        after (tuple[float, str], optional): The distance and uuid of the result ranked at `offset - 1`, if known.
+    """
+    ranked = []
+    window = offset // RESULT_WINDOW_SIZE
+    after = after if offset % RESULT_WINDOW_SIZE == 0 and window > 0 else None
+    if after is not None:
+        previous = await _read_window(generate_results_key(fingerprint, window - 1))
+        last = previous[0][-1] if previous is not None and len(previous[0]) > 0 else None
+        after = (last[1], last[0]) if last is not None and last[0] == after[1] else None
+    while True:
+        items, has_more = await _get_window(body, fingerprint, window, after)
+        start = max(offset - window * RESULT_WINDOW_SIZE, 0)
+        ranked.extend(items[start:start + count - len(ranked)])
+        if not has_more or len(items) == 0:
+            return ranked
+        uuid, distance = items[-1]
+        after = (distance, uuid)
+        window += 1
+        if len(ranked) >= count:
+            break
+
+    task = asyncio.create_task(_prefetch_window(body, fingerprint, window, after))
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+    return ranked
+
 @router.get('', summary="Record details", description="Individual record details", response_model=RecordDetails)
 async def details(id: UUID = Query(..., description="Record UUID"), session: AsyncSession = Depends(get_session)):
     record = await _get_record_by_uuid(id, session)
@@ -62,9 +189,12 @@ large result sets.
     - **Features**: Filters results spatially using GeoJSON-defined geographic boundaries.
     - **Date Range**: Narrows results to a specific time frame using start and end dates.
     - **Epoch**: Allows filtering by predefined temporal periods, such as months or seasons.
+    - **Topic**: Restricts results to records classified under any of the given topics.
 
 - **Pagination**:
     - Results are paginated based on the `page` and `resultsPerPage` parameters.
+    - Alternatively, the `nextCursor` of a response can be passed as `cursor` to fetch the following page,
+      resuming right after the last result served.
 
 - **Threshold**: A filtering parameter that adjusts the relevance threshold for semantic similarity.
 
@@ -73,43 +203,46 @@ large result sets.
 2. SQL filters are dynamically constructed based on the provided filters.
 3. The search is executed against the database using the constructed SQL and embeddings.
 4. Results are returned as a paginated response with metadata about whether more results are available.
+
+The ranking of the results is cached in windows, and the window following the requested page is
+prefetched in the background, so that subsequent pages only need to fetch the details of the records.
     """,
     response_model=SearchJSONResponse | SearchGeoJSONResponse
 )
 async def search(body: SearchBody, session: AsyncSession = Depends(get_session)):
-    sql = SqlConstuctor(page=body.page, results_per_page=body.resultsPerPage, threshold=body.threshold)
-    if body.features is not None and len(body.features) > 0:
-        sql.add('spatial', body.features)
-    elif body.country is not None and len(body.country) > 0:
-        sql.add('country', body.country)
-    if body.dateRange is not None and (body.dateRange.start or body.dateRange.end):
-        start_date = body.dateRange.start.isoformat() if body.dateRange.start is not None else '0001-01-01'
-        end_date = body.dateRange.end.isoformat() if body.dateRange.end is not None else '9999-12-31'
-        sql.add('daterange', start_date, end_date)
-    if body.epoch is not None and len(body.epoch) > 0:
-        months = epoch_to_months(body.epoch)
-        sql.add('epoch', months)
-
-    embedding = inference([body.query])
-
-    stmt = sql.create(embedding[0].tolist(), output=body.output)
-
-    results = await session.execute(stmt)
-
-    data = [dict(row) for row in results.mappings()]
-
-    has_more = len(data) > body.resultsPerPage
-
-    data = data[:body.resultsPerPage]
+    fingerprint = search_fingerprint(body)
+    page, offset, after = body.page, (body.page - 1) * body.resultsPerPage, None
+    if body.cursor is not None:
+        try:
+            page, offset, distance, uuid = decode_cursor(body.cursor, fingerprint)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        after = (distance, uuid)
+
+    ranked = await _get_ranked(body, fingerprint, offset, body.resultsPerPage + 1, after)
+    has_more = len(ranked) > body.resultsPerPage
+    ranked = ranked[:body.resultsPerPage]
+
+    data = []
+    if len(ranked) > 0:
+        stmt = SqlConstuctor(threshold=body.threshold).create_hydration(ranked, output=body.output)
+        results = await session.execute(stmt)
+        data = [dict(row) for row in results.mappings()]
+
+    next_cursor = None
+    if has_more:
+        uuid, distance = ranked[-1]
+        next_cursor = encode_cursor(fingerprint, page + 1, offset + len(ranked), distance, uuid)
     if body.output == 'geojson':
         data = dict(
             type="FeatureCollection",
-            features=[json.loads(list(f.values())[0]) for f in data]
+            features=[json.loads(f['feature']) for f in data]
         )
 
     response = dict(
-        page = body.page,
+        page = page,
         hasMore = has_more,
+        nextCursor = next_cursor,
         data = data
     )
 
@@ -1,3 +1,4 @@
+from enum import Enum
 from pydantic import BaseModel, Field, PositiveInt
 
 from .records import MinimumSearchBody, SearchOutput
@@ -15,11 +16,16 @@ class ClusterSearchBody(MinimumSearchBody):
     """
     Model for the request body of the cluster endpoint.
     """
-    numberOfClusters: int = Field(
+    numberOfClusters: int | None = Field(
         8,
-        description="The number of clusters to be created. Default is 5.",
+        description="The number of clusters to be created. Default is 8. If null, the number of clusters is chosen automatically.",
         example=5
     )
+    maxResults: PositiveInt = Field(
+        1000,
+        description="The maximum number of search results to be clustered, with a maximum limit of 100000. Large values may be further limited by the memory budget of the server.",
+        le=100000
+    )
 
 class MemberClusterSearchBody(ClusterSearchBody):
     """
@@ -27,4 +33,19 @@ class MemberClusterSearchBody(ClusterSearchBody):
     """
     page: PositiveInt = Field(1, description="The page number to retrieve in a paginated search result, starting from 1.")
     resultsPerPage: PositiveInt = Field(10, description="The number of results to include per page in the response, with a maximum limit of 100.", le=100)
-    output: SearchOutput = Field('json', description="Determines the output of the data.")
\ No newline at end of file
+    output: SearchOutput = Field('json', description="Determines the output of the data.")
+
+class ClusterJobStatus(str, Enum):
+    pending = 'pending'
+    clustered = 'clustered'
+    completed = 'completed'
+    failed = 'failed'
+
+class ClusterJobResponse(BaseModel):
+    """
+    Model for the state of an asynchronous clustered search.
+    """
+    jobId: str = Field(..., description="The identifier of the job.")
+    status: ClusterJobStatus = Field(..., description="`pending` until the clusters are formed, `clustered` while their summaries are being generated, then `completed` (or `failed`).")
+    clusters: list[ClusterResponse] | None = Field(None, description="The clusters, available from the `clustered` status on; their summaries are filled in as they are generated.")
+    error: str | None = Field(None, description="The reason of the failure, if the job failed.")
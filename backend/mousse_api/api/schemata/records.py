@@ -37,12 +37,14 @@ class MinimumSearchBody(BaseModel):
     features: list[FeatureModel] | None = Field(None, description="A list of GeoJSON features used for spatial filtering (**intersection**). These features define geographic boundaries or areas of interest for the search. Ignored if `country` is given.")
     dateRange: DateRange | None = Field(None, description="A date range to filter results based on their temporal attributes.")
     epoch: list[Epoch] | None = Field(None, description="A list of time periods to filter results, including specific months (e.g., '01' for January) or seasons (e.g., 'winter' for the winter season).")
+    topic: list[str] | None = Field(None, description="A list of topics to filter results by, as returned in the `topic` of the records. Records having any of them are kept.", example=["geoscientificInformation"])
 
 class SearchBody(MinimumSearchBody):
     page: PositiveInt = Field(1, description="The page number to retrieve in a paginated search result, starting from 1.")
     resultsPerPage: PositiveInt = Field(10, description="The number of results to include per page in the response, with a maximum limit of 100.", le=100)
     threshold: float = Field(0.2, description="A threshold value (between 0 and 1) for filtering or scoring results. Higher values may indicate stricter criteria.", gt=0, lt=1)
     output: SearchOutput = Field('json', description="Determines the output of the data.")
+    cursor: str | None = Field(None, description="The `nextCursor` of a previous response, to fetch the page following it. Takes precedence over `page`; the query, filters and threshold should not change.")
 
 class RecordBase(BaseModel):
     title: str = Field(..., description="The title of the record, summarizing its content or purpose.", example="Lithology of sediment core BACHALP, Bachalpsee, Switzerland")
@@ -61,6 +63,7 @@ class Records(RecordProperties):
 class SearchResponseBase(BaseModel):
     page: PositiveInt = Field(..., description="The current page number of the paginated response.", example=1)
     hasMore: bool = Field(..., description="Indicates whether there are more pages available after the current one.")
+    nextCursor: str | None = Field(None, description="An opaque cursor to fetch the next page, if there are more pages available.")
 
 class SearchJSONResponse(SearchResponseBase):
     data: list[Records] = Field(..., description="A list of records returned in the current page of the search results.")
@@ -1,27 +1,255 @@
 import hashlib
 import json
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from datetime import date
+from uuid import UUID, uuid4
 from dataclasses import asdict, is_dataclass
-from valkey import Valkey
+from pydantic import BaseModel
+from valkey.asyncio import Valkey
 from mousse_api.api.schemata.records import MinimumSearchBody
 
 def generate_query_hash(query_body: MinimumSearchBody) -> str:
     return hashlib.sha256(query_body.model_dump_json().encode()).hexdigest()
 
-def cache_clustered_results(
+# A cluster member is packed as its 16-byte UUID followed by its score as a float32
+CLUSTER_MEMBER_DTYPE = np.dtype([('uuid', 'V16'), ('score', '<f4')])
+
+def generate_clusters_key(query_body: MinimumSearchBody, cluster_id: int | None = None) -> str:
+    query_hash = generate_query_hash(query_body)
+    if cluster_id is None:
+        return f"semsearch:clusters:{query_hash}"
+    return f"semsearch:clusters:{query_hash}:{cluster_id}"
+
+def pack_cluster_members(elements: list[dict]) -> bytes:
+    members = np.empty(len(elements), dtype=CLUSTER_MEMBER_DTYPE)
+    members['uuid'] = np.frombuffer(b"".join(UUID(e['text_id']).bytes for e in elements), dtype='V16')
+    members['score'] = [e['score'] for e in elements]
+    return members.tobytes()
+
+def unpack_cluster_members(packed: bytes) -> list[tuple[str, float]]:
+    members = np.frombuffer(packed, dtype=CLUSTER_MEMBER_DTYPE)
+    return [(str(UUID(bytes=uuid.tobytes())), float(score)) for uuid, score in zip(members['uuid'], members['score'])]
+
+async def cache_clustered_results(
     valkey: Valkey,
     query_body: MinimumSearchBody,
     clustered_result: list,
     ttl_seconds: int = 300
 ):
-    query_hash = generate_query_hash(query_body)
-    valkey_key = f"semsearch:clusters:{query_hash}"
-    valkey.setex(valkey_key, ttl_seconds, json.dumps([asdict(r) if is_dataclass(r) else r for r in clustered_result]))
+    """
+    Caches the clusters of a query.
 
-def get_cached_clusters(
+    The clusters are stored as a small JSON summary (without the elements), and the elements
+    of every cluster as a separate key of packed members (see `CLUSTER_MEMBER_DTYPE`), in
+    descending score order, so that a page of members can be read with `GETRANGE`. All the keys
+    are written in a single transaction, so that the summary is never cached without its members.
+    """
+    clustered_result = [asdict(r) if is_dataclass(r) else r for r in clustered_result]
+    summary = [
+        {key: value for key, value in cluster.items() if key != 'elements'} | {'element_count': len(cluster['elements'])}
+        for cluster in clustered_result
+    ]
+    async with valkey.pipeline(transaction=True) as pipe:
+        pipe.setex(generate_clusters_key(query_body), ttl_seconds, json.dumps(summary))
+        for cluster in clustered_result:
+            pipe.setex(generate_clusters_key(query_body, cluster['id']), ttl_seconds, pack_cluster_members(cluster['elements']))
+        await pipe.execute()
+
+async def get_cached_clusters(
     valkey: Valkey,
     query_body: MinimumSearchBody
 ) -> list|None:
-    query_hash = generate_query_hash(query_body)
-    valkey_key = f"semsearch:clusters:{query_hash}"
-    cached = valkey.get(valkey_key)
+    """Returns the cached summary of the clusters of a query, without their elements."""
+    cached = await valkey.get(generate_clusters_key(query_body))
+    return json.loads(cached) if cached else None
+
+async def refresh_clustered_results(
+    valkey: Valkey,
+    query_body: MinimumSearchBody,
+    cluster_ids: list[int],
+    ttl_seconds: int = 300
+):
+    """Extends the expiration of the cached clusters of a query, without re-writing them, in a single round trip."""
+    async with valkey.pipeline(transaction=False) as pipe:
+        pipe.expire(generate_clusters_key(query_body), ttl_seconds)
+        for cluster_id in cluster_ids:
+            pipe.expire(generate_clusters_key(query_body, cluster_id), ttl_seconds)
+        await pipe.execute()
+
+async def update_cluster_summaries(
+    valkey: Valkey,
+    query_body: MinimumSearchBody,
+    summaries: dict[str, str]
+):
+    """Fills late summaries into the cached clusters of a query, if they are still cached, keeping their expiration."""
+    key = generate_clusters_key(query_body)
+    cached = await valkey.get(key)
+    if not cached:
+        return
+    clusters = json.loads(cached)
+    for cluster in clusters:
+        cluster['summary'] = summaries.get(str(cluster['id']), cluster['summary'])
+    await valkey.set(key, json.dumps(clusters), xx=True, keepttl=True)
+
+async def get_cached_cluster_members(
+    valkey: Valkey,
+    query_body: MinimumSearchBody,
+    cluster_id: int,
+    start: int,
+    stop: int
+) -> list[tuple[str, float]]:
+    """Returns the uuids and scores of the cached members of a cluster, from index `start` (inclusive) to `stop` (exclusive)."""
+    if stop <= start:
+        return []
+    item_size = CLUSTER_MEMBER_DTYPE.itemsize
+    packed = await valkey.getrange(generate_clusters_key(query_body, cluster_id), start * item_size, stop * item_size - 1)
+    return unpack_cluster_members(packed)
+
+def generate_ner_key(query: str, prompt_version: str, model_name: str, day: date) -> str:
+    digest = hashlib.sha256("\0".join([model_name, query]).encode()).hexdigest()
+    return f"semsearch:ner:{prompt_version}:{day.isoformat()}:{digest}"
+
+async def cache_ner_result(
+    valkey: Valkey,
+    key: str,
+    result: BaseModel,
+    ttl_seconds: int = 86400
+):
+    await valkey.setex(key, ttl_seconds, result.model_dump_json())
+
+async def get_cached_ner_result(
+    valkey: Valkey,
+    key: str
+) -> bytes|None:
+    return await valkey.get(key)
+
+def generate_job_key(job_id: str) -> str:
+    return f"semsearch:jobs:{job_id}"
+
+async def cache_job(
+    valkey: Valkey,
+    job_id: str,
+    state: dict,
+    ttl_seconds: int = 900
+):
+    await valkey.setex(generate_job_key(job_id), ttl_seconds, json.dumps(state))
+
+async def get_cached_job(
+    valkey: Valkey,
+    job_id: str
+) -> dict|None:
+    cached = await valkey.get(generate_job_key(job_id))
     return json.loads(cached) if cached else None
+
+def generate_results_key(fingerprint: str, window: int) -> str:
+    return f"semsearch:results:{fingerprint}:{window}"
+
+async def cache_result_window(
+    valkey: Valkey,
+    key: str,
+    ranked: list[tuple[str, float]],
+    has_more: bool,
+    ttl_seconds: int = 300
+):
+    await valkey.setex(key, ttl_seconds, json.dumps({"r": ranked, "m": has_more}))
+
+async def get_cached_result_window(
+    valkey: Valkey,
+    key: str
+) -> tuple[list[tuple[str, float]], bool]|None:
+    cached = await valkey.get(key)
+    if not cached:
+        return None
+    cached = json.loads(cached)
+    return [(uuid, distance) for uuid, distance in cached["r"]], cached["m"]
+
+class ByteBoundedLRU:
+    """
+    In-process LRU cache of NumPy arrays, bounded by the total size of the stored arrays.
+
+    Attributes:
+        max_bytes (int): Maximum total size (in bytes) of the stored arrays.
+        size (int): Current total size (in bytes) of the stored arrays.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    def get(self, key: str) -> np.ndarray | None:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: np.ndarray) -> None:
+        if value.nbytes > self.max_bytes:
+            return
+        previous = self._data.pop(key, None)
+        if previous is not None:
+            self.size -= previous.nbytes
+        self._data[key] = value
+        self.size += value.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= evicted.nbytes
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query text, so that trivially different spellings of the same query share cache entries.
+
+    Applies Unicode NFKC normalization, strips leading/trailing whitespace and collapses inner whitespace.
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+def generate_embedding_key(query: str, model_name: str, task_description: str) -> str:
+    digest = hashlib.sha256("\0".join([model_name, task_description, query]).encode()).hexdigest()
+    return f"semsearch:embedding:{digest}"
+
+async def cache_embedding(
+    valkey: Valkey,
+    key: str,
+    embedding: np.ndarray,
+    ttl_seconds: int = 86400
+):
+    await valkey.setex(key, ttl_seconds, embedding.astype('<f4').tobytes())
+
+async def get_cached_embedding(
+    valkey: Valkey,
+    key: str
+) -> np.ndarray|None:
+    cached = await valkey.get(key)
+    return np.frombuffer(cached, dtype='<f4') if cached else None
+
+# Deletes the lock only if it is still held by the caller
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+async def acquire_lock(
+    valkey: Valkey,
+    key: str,
+    ttl_seconds: float = 60
+) -> str|None:
+    """
+    Tries to acquire a lock, which expires after `ttl_seconds` in case the holder never releases it.
+
+    Returns:
+        str|None: A token to release the lock with, or None if the lock is held by someone else.
+    """
+    token = uuid4().hex
+    acquired = await valkey.set(key, token, nx=True, px=int(ttl_seconds * 1000))
+    return token if acquired else None
+
+async def release_lock(
+    valkey: Valkey,
+    key: str,
+    token: str
+):
+    await valkey.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
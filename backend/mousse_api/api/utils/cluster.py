@@ -1,15 +1,20 @@
+import os
 import json
+import asyncio
 import numpy as np
 
-from collections import defaultdict
 from dataclasses import dataclass, field
 from json_repair import repair_json
-from sklearn.cluster import KMeans
 from pydantic import RootModel, model_validator
-from typing import Dict, List, Optional, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from fastapi import Request
 from mousse_api.api.utils.prompts import SUMMARY_INSTRUCTION_BATCHED
 from mousse_api.api.utils.llm import llm_request, LLMException
+from mousse_api.api.utils.kmeans import CLUSTER_ENGINE, choose_n_clusters, get_engine, group_by_label
+from mousse_api.logger import logger
+
+SUMMARY_CONCURRENCY = int(os.getenv("CLUSTER_SUMMARY_CONCURRENCY", 2))
+SUMMARY_TIMEOUT = float(os.getenv("CLUSTER_SUMMARY_TIMEOUT", 60))
 
 class ClusterTitles(RootModel[Dict[str, str]]):
 
@@ -50,8 +55,11 @@ class ClusterClassifier:
         texts: List[str],
         text_ids: List[str],
         projections: np.ndarray,
-        request: Request,
+        request: Optional[Request],
         scores: Optional[List[float]] = None,
+        summary_concurrency: int = SUMMARY_CONCURRENCY,
+        summary_timeout: float = SUMMARY_TIMEOUT,
+        engine: str = CLUSTER_ENGINE,
     ) -> None:
         """
         Initialize the ClusterClassifier.
@@ -60,8 +68,12 @@ class ClusterClassifier:
             texts: List of text documents to cluster.
             text_ids: List of IDs for the texts. If None, indices will be used.
             scores: List of scores for the texts. If None, all scores will be set to 0.
-            request: FastAPI request object for accessing headers.
+            request: FastAPI request object for accessing headers. Should be None if the summaries
+                may outlive the request.
             projections: Projected embeddings (e.g., after PCA), shape (n_docs, proj_dim).
+            summary_concurrency: Maximum number of summary batches generated concurrently.
+            summary_timeout: Timeout (in seconds) of the generation of a summary batch.
+            engine: Name of the clustering engine (see `mousse_api.api.utils.kmeans.ENGINES`).
         """
         self.summary_instruction = SUMMARY_INSTRUCTION_BATCHED
 
@@ -70,36 +82,48 @@ class ClusterClassifier:
         self.scores = scores if scores is not None else [0.0] * len(texts)
         self.projected_embeddings = projections
         self._request = request
+        self._summary_semaphore = asyncio.Semaphore(max(1, summary_concurrency))
+        self._summary_timeout = summary_timeout
+        self._pending_summaries: List[asyncio.Task] = []
+        self._engine = get_engine(engine)
 
     async def fit(
         self,
-        n_clusters: int = 8,
+        n_clusters: Optional[int] = 8,
+        summary_wait: Optional[float] = None,
     ) -> List[Cluster]:
         """
         Fit the cluster classifier on text data.
 
         This method performs clustering on the provided embeddings or projections and
-        optionally generates summaries for each cluster.
+        optionally generates summaries for each cluster. The CPU-bound steps (the clustering and
+        the creation of the cluster objects) run in a thread, so as not to block the event loop.
 
         Args:
-            n_clusters: Number of clusters for K-means clustering.
+            n_clusters: Number of clusters for K-means clustering. If None, it is chosen automatically.
+            summary_wait: Maximum time (in seconds) to wait for the summaries. The clusters whose
+                summaries are late are returned without them, and the late summaries can be
+                awaited with `late_summaries`. If None, all the summaries are awaited.
 
         Returns:
             List of Cluster objects
         """
-        cluster_labels, cluster_representatives = self.cluster(
-            self.projected_embeddings, n_clusters
+        cluster_labels, cluster_representatives = await asyncio.to_thread(
+            self.cluster, self.projected_embeddings, n_clusters
         )
 
-        label2docs = defaultdict(list)
-        for i, label in enumerate(cluster_labels):
-            label2docs[label].append(i)
+        order, offsets = group_by_label(cluster_labels)
+        label2docs = {
+            int(label): order[offsets[label]:offsets[label + 1]]
+            for label in np.flatnonzero(np.diff(offsets))
+        }
 
         cluster_summaries = await self._generate_summaries(
-            cluster_labels=cluster_labels, label2docs=label2docs
+            cluster_labels=cluster_labels, label2docs=label2docs, wait=summary_wait
         )
 
-        clusters = self._create_cluster_objects(
+        clusters = await asyncio.to_thread(
+            self._create_cluster_objects,
             cluster_labels=cluster_labels,
             cluster_representatives=cluster_representatives,
             cluster_summaries=cluster_summaries,
@@ -127,14 +151,15 @@ class ClusterClassifier:
             raise ValueError(f"Invalid sort_by value: {sort_by}")
 
     def cluster(
-        self, embeddings: np.ndarray, n_clusters: int
+        self, embeddings: np.ndarray, n_clusters: Optional[int]
     ) -> Tuple[np.ndarray, Dict[int, int]]:
         """
         Perform K-means clustering on document embeddings.
 
         Args:
             embeddings: Document embeddings matrix to cluster
-            n_clusters: Number of clusters to create
+            n_clusters: Number of clusters to create, at most the number of documents. If None,
+                the number maximizing the silhouette score is chosen.
 
         Returns:
             Tuple containing:
@@ -142,16 +167,10 @@ class ClusterClassifier:
                 - representative document indices for each cluster
         """
 
-        try:
-            clustering = KMeans(
-                n_clusters=n_clusters, random_state=42, tol=1e-6, max_iter=1000
-            ).fit(embeddings)
-        except ValueError:
-            clustering = KMeans(
-                n_clusters=5, random_state=42, tol=1e-6, max_iter=1000
-            ).fit(embeddings)
-
-        labels = clustering.labels_
+        if n_clusters is None:
+            _, labels = choose_n_clusters(embeddings, self._engine)
+        else:
+            labels = self._engine(embeddings, max(1, min(n_clusters, len(embeddings))), 42)
 
         representatives = self._find_representatives(labels)
 
@@ -170,21 +189,16 @@ class ClusterClassifier:
             Dictionary mapping cluster labels to their representative document indices.
         """
 
-        unique_labels = np.unique(labels)
-        representatives = {}
-
-        for label in unique_labels:
+        points = self.projected_embeddings
+        counts = np.bincount(labels)
+        centers = np.zeros((len(counts), points.shape[1]))
+        np.add.at(centers, labels, points)
+        centers /= np.maximum(counts, 1)[:, None]
+        distances = np.linalg.norm(points - centers[labels], axis=1)
 
-            cluster_points = self.projected_embeddings[labels == label]
-            cluster_indices = np.where(labels == label)[0]  # Indices of points in this cluster
-
-            center = np.mean(cluster_points, axis=0)
-            distances = np.linalg.norm(cluster_points - center, axis=1)
-            representative_index_in_cluster = np.argmin(distances)
-
-            representatives[label] = cluster_indices[representative_index_in_cluster]
-
-        return representatives
+        # Within every cluster, the closest document comes first
+        order, offsets = group_by_label(labels, distances)
+        return {int(label): int(order[offsets[label]]) for label in np.flatnonzero(counts)}
 
     def _create_cluster_objects(
         self,
@@ -199,15 +213,14 @@ class ClusterClassifier:
             List of Cluster objects.
         """
         clusters = []
-        unique_labels = set(cluster_labels)
+        # Within every cluster, the elements are sorted by descending score
+        order, offsets = group_by_label(cluster_labels, -np.asarray(self.scores, dtype=float))
 
-        for label in unique_labels:
+        for label in np.flatnonzero(np.diff(offsets)):
             # Get indices of texts in this cluster
 
-            cluster_indices = [i for i, l in enumerate(cluster_labels) if l == label]
-            rep_idx = cluster_representatives.get(
-                label, cluster_indices[0] if cluster_indices else None
-            )
+            cluster_indices = order[offsets[label]:offsets[label + 1]]
+            rep_idx = cluster_representatives.get(int(label), cluster_indices[0])
 
             cluster_elements = [
                 ClusterElement(
@@ -217,13 +230,10 @@ class ClusterClassifier:
                 )
                 for i in cluster_indices
             ]
-            cluster_elements.sort(key=lambda element: element.score, reverse=True)
 
             # Get representative ID and text
-            representative_id = (
-                str(self.text_ids[rep_idx]) if rep_idx is not None else None
-            )
-            representative_text = self.texts[rep_idx] if rep_idx is not None else None
+            representative_id = str(self.text_ids[rep_idx])
+            representative_text = self.texts[rep_idx]
 
             clusters.append(
                 Cluster(
@@ -237,18 +247,71 @@ class ClusterClassifier:
 
         return clusters
 
+    async def late_summaries(
+        self,
+        on_batch: Optional[Callable[[Dict[str, str]], Awaitable[None]]] = None
+    ) -> Dict[str, str]:
+        """
+        Wait for the summaries that were not ready when `fit` returned.
+
+        Args:
+            on_batch: Called with the summaries of every batch, as soon as the batch is ready.
+
+        Returns:
+            Dictionary mapping cluster IDs to their summaries.
+        """
+        cluster_summaries = {}
+        for batch in asyncio.as_completed(self._pending_summaries):
+            batch_summaries = await batch
+            cluster_summaries.update(batch_summaries)
+            if on_batch is not None and batch_summaries:
+                await on_batch(batch_summaries)
+        self._pending_summaries = []
+        return cluster_summaries
+
+    async def _summarize_batch(self, combined_examples: str) -> Dict[str, str]:
+        """
+        Generate the summaries of a batch of clusters, within the concurrency limit and the timeout.
+
+        Returns:
+            Dictionary mapping cluster IDs to their summaries; empty if the generation failed.
+        """
+        async with self._summary_semaphore:
+            try:
+                batch_summaries = await asyncio.wait_for(
+                    llm_request(
+                        query=combined_examples,
+                        system_prompt=self.summary_instruction,
+                        request=self._request,
+                        PydanticModel=ClusterTitles,
+                        max_requests=3,
+                        max_tokens=1024,
+                        temperature=0.6,
+                    ),
+                    timeout=self._summary_timeout,
+                )
+            except (LLMException, asyncio.TimeoutError) as e:
+                logger.warning("Could not generate cluster summaries: %s", str(e) or "timeout")
+                return {}
+        return batch_summaries.model_dump()
+
     async def _generate_summaries(
         self,
         cluster_labels: np.ndarray,
         label2docs: Optional[Dict[int, List[int]]] = None,
+        wait: Optional[float] = None,
     ) -> Dict[int, str]:
         """
-        Generate summaries for clusters in batches.
+        Generate summaries for clusters in batches, generated concurrently.
+
+        Args:
+            wait: Maximum time (in seconds) to wait for the batches. Late batches keep running and
+                can be awaited with `late_summaries`. If None, all the batches are awaited.
 
         Returns:
             Dictionary mapping cluster IDs to their summaries.
         """
-        unique_labels = sorted(set(cluster_labels))
+        unique_labels = np.unique(cluster_labels).tolist()
         cluster_count = len(unique_labels)
         summary_num_batches = 2
         summary_examples = 10
@@ -264,7 +327,10 @@ class ClusterClassifier:
             end_idx = (i + 1) * cluster_count // summary_num_batches
             batches.append(unique_labels[start_idx:end_idx])
 
+        tasks = []
         for batch_idx, batch in enumerate(batches):
+            if len(batch) == 0:
+                continue
 
             batch_examples = []
             batch_cluster_ids = []
@@ -290,21 +356,15 @@ class ClusterClassifier:
 
             combined_examples = "\n\n====NEXT CLUSTER====\n\n".join(batch_examples)
 
-            try:
-                batch_summaries = await llm_request(
-                    query=combined_examples,
-                    system_prompt=self.summary_instruction,
-                    request=self._request,
-                    PydanticModel=ClusterTitles,
-                    max_requests=3,
-                    max_tokens=1024,
-                    temperature=0.6,
-                )
-                batch_summaries = batch_summaries.model_dump()
-            except LLMException as e:
-                batch_summaries = {}
+            tasks.append(asyncio.create_task(self._summarize_batch(combined_examples)))
 
-            cluster_summaries.update(batch_summaries)
+        if len(tasks) == 0:
+            return cluster_summaries
+        done, pending = await asyncio.wait(tasks, timeout=wait)
+        for task in tasks:
+            if task in done:
+                cluster_summaries.update(task.result())
+        self._pending_summaries = [task for task in tasks if task in pending]
 
         return cluster_summaries
 
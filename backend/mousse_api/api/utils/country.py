@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from sqlalchemy import select, text, bindparam, String
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from mousse_api.db.models import Countries
+
+COUNTRY_GEOMETRY_CACHE_SIZE = 256
+
+_country_geometries: OrderedDict[tuple[str, ...], bytes] = OrderedDict()
+
+_country_codes: dict[str, str] | None = None
+
+async def get_country_codes(session: AsyncSession) -> dict[str, str]:
+    """
+    Returns the mapping of the (english) country names to their codes.
+
+    The countries are read once per process and served from memory afterwards.
+
+    Args:
+        session (AsyncSession): The database session.
+
+    Returns:
+        dict[str, str]: The country codes, by label.
+    """
+    global _country_codes
+    if _country_codes is None:
+        result = await session.execute(select(Countries.label, Countries.code))
+        _country_codes = {label: code for label, code in result.all()}
+    return _country_codes
+
+async def get_country_geometry(session: AsyncSession, country_list: list[str]) -> bytes | None:
+    """
+    Returns the simplified union of the geometries of the given countries, as EWKB.
+
+    The geometry of a single country is read from the precomputed `core.country_geometry` table,
+    while the union of multiple countries is computed once (with the same simplification). In
+    both cases, the result is memoized per set of country codes in an in-process LRU cache
+    (unless no country matched).
+
+    Args:
+        session (AsyncSession): The database session.
+        country_list (list[str]): A list of country codes.
+
+    Returns:
+        bytes | None: The EWKB representation of the geometry, or None if no country matched.
+    """
+    key = tuple(sorted(set(country_list)))
+    if key in _country_geometries:
+        _country_geometries.move_to_end(key)
+        return _country_geometries[key]
+
+    if len(key) == 1:
+        stmt = text("""
+            SELECT ST_AsEWKB(geometry)
+            FROM core.country_geometry
+            WHERE "code" = :code
+        """).bindparams(bindparam("code", value=key[0], type_=String))
+    else:
+        stmt = text("""
+            SELECT ST_AsEWKB(ST_MakeValid(ST_Simplify(ST_Union(geometry), 0.1)))
+            FROM core.countries
+            WHERE "code" = ANY(:codes)
+        """).bindparams(bindparam("codes", value=list(key), type_=ARRAY(String)))
+    geometry = (await session.execute(stmt)).scalar()
+    # Misses are not memoized, as the geometry may be precomputed after the process started
+    if geometry is None:
+        return None
+
+    _country_geometries[key] = bytes(geometry)
+    while len(_country_geometries) > COUNTRY_GEOMETRY_CACHE_SIZE:
+        _country_geometries.popitem(last=False)
+    return _country_geometries[key]
@@ -20,3 +20,21 @@ def epoch_to_months(epoch):
         if season in epoch:
             months.extend(seasons[season])
     return list(set(months))
+
+def months_to_mask(months):
+    """
+    Converts a list of months to a 12-bit month mask.
+
+    Bit 0 of the mask stands for January and bit 11 for December, matching the
+    `month_mask` column of `core.record_time_range`.
+
+    Args:
+        months (list[int]): A list of month numbers (1-12).
+
+    Returns:
+        int: The month mask.
+    """
+    mask = 0
+    for month in months:
+        mask |= 1 << (int(month) - 1)
+    return mask
@@ -1,43 +1,306 @@
 import os
+import asyncio
+import itertools
+from functools import lru_cache
 import numpy as np
 import tritonclient.grpc as grpcclient
+import tritonclient.grpc.aio as aio_grpcclient
+from tritonclient.utils import InferenceServerException
+from valkey.exceptions import ValkeyError
 
-def inference(inputs_texts: list[str]) -> list[list[float]]:
+from mousse_api.logger import logger
+from mousse_api.valkey_client import get_valkey_client
+from mousse_api.api.utils.cache import ByteBoundedLRU, normalize_query, generate_embedding_key, cache_embedding, get_cached_embedding
+from mousse_api.api.utils import metrics
+
+RETRYABLE_STATUSES = (
+    "StatusCode.UNAVAILABLE",
+    "StatusCode.DEADLINE_EXCEEDED",
+    "StatusCode.RESOURCE_EXHAUSTED",
+)
+
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 86400))
+
+embedding_lru = ByteBoundedLRU(max_bytes=int(os.getenv("EMBEDDING_CACHE_BYTES", 64 * 1024 * 1024)))
+
+batch_size_metric = metrics.summary("embedding_batch_size", "Number of texts sent to the inference server per batch")
+batch_fill_metric = metrics.summary("embedding_batch_fill", "Ratio of the batch size to the maximum batch size")
+queue_latency_metric = metrics.summary("embedding_queue_latency_seconds", "Time a query waited in the coalescer before being sent")
+
+class EmbeddingClient:
+    """
+    Long-lived asynchronous client for the Triton embedding model.
+
+    Keeps a pool of gRPC channels open to the Triton Inference Server and distributes
+    the inference calls among them in a round-robin fashion. Every call is bounded by
+    a deadline and retried with an exponential backoff on transient failures.
+
+    Attributes:
+        url (str): The gRPC endpoint (host:port) of the Triton Inference Server.
+        model_name (str): The name of the model used for inference.
+        pool_size (int): The number of gRPC channels kept open.
+        timeout (float): Deadline (in seconds) for a single inference call.
+        max_retries (int): Maximum number of retries on transient failures.
+        backoff (float): Initial backoff (in seconds) between retries; doubled on each retry.
+    """
+
+    def __init__(self, url: str, model_name: str, pool_size: int = 4, timeout: float = 10.0, max_retries: int = 3, backoff: float = 0.1):
+        self.url = url
+        self.model_name = model_name
+        self.pool_size = max(1, pool_size)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._clients = []
+        self._pool = None
+
+    def _next_client(self) -> aio_grpcclient.InferenceServerClient:
+        """
+        Returns the next client of the pool, creating the pool on first use.
+
+        The channels are created lazily, so that they are bound to the event loop of the
+        worker process and not to the one of the (preloading) master process.
+        """
+        if self._pool is None:
+            keepalive = grpcclient.KeepAliveOptions(keepalive_time_ms=30000, keepalive_permit_without_calls=True)
+            self._clients = [
+                aio_grpcclient.InferenceServerClient(
+                    url=self.url,
+                    keepalive_options=keepalive,
+                    # Separate subchannel pools force a distinct HTTP/2 connection per client.
+                    channel_args=[("grpc.use_local_subchannel_pool", 1)],
+                )
+                for _ in range(self.pool_size)
+            ]
+            self._pool = itertools.cycle(self._clients)
+        return next(self._pool)
+
+    async def infer(self, inputs_texts: list[str]) -> np.ndarray:
+        """
+        Computes the embeddings of the given texts.
+
+        Args:
+            inputs_texts (list[str]): A list of strings to be used as input for the model.
+
+        Returns:
+            np.ndarray: The embeddings produced by the model for the input texts.
+
+        Raises:
+            InferenceServerException: If inference fails after all retries, or with a non-transient error.
+        """
+        output = grpcclient.InferRequestedOutput(name="EMBEDDINGS")
+
+        input_data = np.array(inputs_texts, dtype=object).reshape(-1, 1)
+        inputs = grpcclient.InferInput(name="TEXT", shape=input_data.shape, datatype="BYTES")
+        inputs.set_data_from_numpy(input_data)
+
+        attempt = 0
+        while True:
+            try:
+                response = await self._next_client().infer(
+                    model_name=self.model_name,
+                    inputs=[inputs],
+                    outputs=[output],
+                    client_timeout=self.timeout,
+                )
+            except InferenceServerException as e:
+                if e.status() not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                logger.warning("Inference failed (%s), retrying in %.2fs [%d/%d]", e.status(), delay, attempt, self.max_retries)
+                await asyncio.sleep(delay)
+            else:
+                return response.as_numpy("EMBEDDINGS")
+
+    async def close(self) -> None:
+        """Closes all the channels of the pool."""
+        clients, self._clients, self._pool = self._clients, [], None
+        for client in clients:
+            await client.close()
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests into batched inference calls.
+
+    Queries arriving within a small time window (or until the maximum batch size is reached)
+    are sent together as one `TEXT` tensor, and the rows of the resulting `EMBEDDINGS` are
+    handed back to the waiting callers. Identical texts within a batch are embedded once.
+
+    Attributes:
+        client (EmbeddingClient): The client used for inference.
+        max_batch_size (int): Maximum number of texts in a batch; should not exceed the `max_batch_size` of the model.
+        window (float): Maximum time (in seconds) the first query of a batch waits for others to join.
+    """
+
+    def __init__(self, client: EmbeddingClient, max_batch_size: int = 4, window: float = 0.005):
+        self.client = client
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = window
+        self._pending: list[tuple[str, asyncio.Future, float]] = []
+        self._timer: asyncio.Handle | None = None
+        # Keeps a reference to the running batches, so that they are not garbage collected
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> np.ndarray:
+        """
+        Queues a text for embedding and waits for its batch to complete.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            np.ndarray: The (1-dimensional) embedding of the text.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future, loop.time()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+        if len(self._pending) > 0:
+            self._timer = asyncio.get_running_loop().call_soon(self._flush)
+        if len(batch) > 0:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future, float]]) -> None:
+        now = asyncio.get_running_loop().time()
+        for _, _, enqueued in batch:
+            queue_latency_metric.observe(now - enqueued)
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        batch_size_metric.observe(len(texts))
+        batch_fill_metric.observe(len(texts) / self.max_batch_size)
+
+        try:
+            embeddings = await self.client.infer(texts)
+        except asyncio.CancelledError:
+            # e.g. at shutdown: the callers are cancelled too, instead of waiting forever
+            for _, future, _ in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        rows = dict(zip(texts, embeddings))
+        for text, future, _ in batch:
+            if not future.done():
+                future.set_result(rows[text])
+
+@lru_cache(maxsize=None)
+def get_embedding_client() -> EmbeddingClient:
+    """
+    Creates and caches the process-wide embedding client.
+
+    Environment Variables:
+        - TRITON_URL: The base URL of the Triton Inference Server.
+        - TRITON_MODEL_NAME: The name of the model to be used for inference.
+        - TRITON_POOL_SIZE: Number of gRPC channels kept open (default: 4).
+        - TRITON_TIMEOUT: Deadline of an inference call in seconds (default: 10).
+        - TRITON_MAX_RETRIES: Maximum retries on transient errors (default: 3).
+        - TRITON_BACKOFF: Initial backoff between retries in seconds (default: 0.1).
+
+    Returns:
+        EmbeddingClient: The embedding client instance.
+    """
+    return EmbeddingClient(
+        url=os.getenv("TRITON_URL") + ':8001',
+        model_name=os.getenv("TRITON_MODEL_NAME"),
+        pool_size=int(os.getenv("TRITON_POOL_SIZE", 4)),
+        timeout=float(os.getenv("TRITON_TIMEOUT", 10)),
+        max_retries=int(os.getenv("TRITON_MAX_RETRIES", 3)),
+        backoff=float(os.getenv("TRITON_BACKOFF", 0.1)),
+    )
+
+@lru_cache(maxsize=None)
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """
+    Creates and caches the process-wide embedding request coalescer.
+
+    Environment Variables:
+        - EMBEDDING_BATCH_SIZE: Maximum number of queries per batch (default: 4).
+        - EMBEDDING_BATCH_WINDOW_MS: Time window for gathering a batch in milliseconds (default: 5).
+
+    Returns:
+        EmbeddingBatcher: The embedding batcher instance.
+    """
+    return EmbeddingBatcher(
+        client=get_embedding_client(),
+        max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 4)),
+        window=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5)) / 1000,
+    )
+
+async def close_embedding_client() -> None:
+    """Closes the process-wide embedding client, if it has been created."""
+    if get_embedding_client.cache_info().currsize > 0:
+        await get_embedding_client().close()
+        get_embedding_client.cache_clear()
+        get_embedding_batcher.cache_clear()
+
+async def inference(inputs_texts: list[str]) -> np.ndarray:
     """
     Perform inference on a list of input texts using Triton Inference Server.
 
-    This function connects to a Triton server specified by environment variables 
-    and performs inference using a pre-configured model. The input texts are 
-    sent to the model, and the embeddings produced by the model are returned.
+    The inference is delegated to the process-wide, pooled embedding client,
+    so no connection is established per call and the event loop is never blocked.
 
     Args:
         inputs_texts (list[str]): A list of strings to be used as input for the model.
 
     Returns:
-        list[float]: A list of embeddings produced by the model for the input texts.
+        np.ndarray: The embeddings produced by the model for the input texts.
 
     Raises:
-        Exception: If there are any issues connecting to the Triton server or during inference.
+        InferenceServerException: If there are any issues connecting to the Triton server or during inference.
+    """
+    return await get_embedding_client().infer(inputs_texts)
 
-    Environment Variables:
-        - TRITON_URL: The base URL of the Triton Inference Server.
-        - TRITON_GRPC_PORT: The gRPC port of the Triton Inference Server.
-        - TRITON_MODEL_NAME: The name of the model to be used for inference.
+async def embed_query(query: str) -> np.ndarray:
     """
-    triton_url = os.getenv("TRITON_URL") + ':8001'
-    triton_client = grpcclient.InferenceServerClient(url=triton_url)
+    Computes the embedding of a search query, going through a two-tier cache.
 
-    output = grpcclient.InferRequestedOutput(name="EMBEDDINGS")
+    The query is normalized and looked up first in the in-process LRU cache and then in Valkey,
+    where the embeddings are shared among all the workers. Only when both tiers miss, the
+    embedding is computed by the inference server, batched together with other concurrent
+    queries, and stored in both tiers. Cache failures
+    are logged and never fail the request.
 
-    input_data = np.array([inputs_texts], dtype=object)
-    inputs = grpcclient.InferInput(name="TEXT", shape=input_data.shape, datatype="BYTES")
+    Args:
+        query (str): The search query.
 
-    inputs.set_data_from_numpy(input_data)
+    Returns:
+        np.ndarray: The (1-dimensional) embedding of the query.
+    """
+    query = normalize_query(query)
+    key = generate_embedding_key(query, os.getenv("TRITON_MODEL_NAME", ""), os.getenv("TASK_DESCRIPTION", ""))
 
-    response = triton_client.infer(
-        model_name=os.getenv("TRITON_MODEL_NAME"),
-        inputs=[inputs],
-        outputs=[output]
-    )
+    embedding = embedding_lru.get(key)
+    if embedding is not None:
+        return embedding
+
+    valkey = get_valkey_client()
+    try:
+        embedding = await get_cached_embedding(valkey, key)
+    except ValkeyError as e:
+        logger.warning("Could not read embedding from cache: %s", e)
+    if embedding is None:
+        embedding = (await get_embedding_batcher().embed(query)).astype(np.float32)
+        try:
+            await cache_embedding(valkey, key, embedding, ttl_seconds=EMBEDDING_CACHE_TTL)
+        except ValkeyError as e:
+            logger.warning("Could not write embedding to cache: %s", e)
 
-    return response.as_numpy("EMBEDDINGS")
+    embedding_lru.set(key, embedding)
+    return embedding
@@ -0,0 +1,115 @@
+import os
+import numpy as np
+from typing import Callable, Dict, Optional, Tuple
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+
+CLUSTER_ENGINE = os.getenv("CLUSTER_ENGINE", "relaxed")
+AUTO_K_MAX = int(os.getenv("CLUSTER_AUTO_K_MAX", 12))
+AUTO_K_SAMPLE_SIZE = int(os.getenv("CLUSTER_AUTO_K_SAMPLE_SIZE", 2000))
+
+# An engine partitions the points into (at most) `n_clusters` clusters, returning a label per point
+ClusteringEngine = Callable[[np.ndarray, int, int], np.ndarray]
+
+def _kmeans(points: np.ndarray, n_clusters: int, random_state: int) -> np.ndarray:
+    """Exact K-means (scikit-learn), as in the original implementation."""
+    return KMeans(n_clusters=n_clusters, random_state=random_state, tol=1e-6, max_iter=1000).fit(points).labels_
+
+def _minibatch_kmeans(points: np.ndarray, n_clusters: int, random_state: int) -> np.ndarray:
+    """Mini-batch K-means (scikit-learn), trading some accuracy for speed on large inputs."""
+    return MiniBatchKMeans(
+        n_clusters=n_clusters, random_state=random_state, batch_size=2048, n_init=3, max_no_improvement=5
+    ).fit(points).labels_
+
+def _relaxed_kmeans(
+    points: np.ndarray,
+    n_clusters: int,
+    random_state: int,
+    tol: float = 1e-4,
+    max_iter: int = 300,
+    warm_sample_size: int = 5000,
+) -> np.ndarray:
+    """
+    K-means (scikit-learn) with a relaxed tolerance, warm-started from the centers of a sample.
+
+    The centers are first fitted on a sample of the points, which is cheap, and then refined on
+    all of them, which takes fewer iterations than starting from a k-means++ seeding.
+    """
+    init = "k-means++"
+    if len(points) > warm_sample_size:
+        rng = np.random.default_rng(random_state)
+        sample = points[rng.choice(len(points), size=warm_sample_size, replace=False)]
+        init = KMeans(n_clusters=n_clusters, random_state=random_state, tol=tol, n_init=1).fit(sample).cluster_centers_
+    return KMeans(
+        n_clusters=n_clusters, init=init, random_state=random_state, tol=tol, max_iter=max_iter, n_init=1
+    ).fit(points).labels_
+
+ENGINES: Dict[str, ClusteringEngine] = {
+    "kmeans": _kmeans,
+    "minibatch": _minibatch_kmeans,
+    "relaxed": _relaxed_kmeans,
+}
+
+def get_engine(name: str = CLUSTER_ENGINE) -> ClusteringEngine:
+    """
+    Returns a clustering engine by name.
+
+    Raises:
+        ValueError: If there is no such engine.
+    """
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError(f"Unknown clustering engine '{name}', expected one of {sorted(ENGINES)}")
+
+def choose_n_clusters(
+    points: np.ndarray,
+    engine: ClusteringEngine,
+    max_clusters: int = AUTO_K_MAX,
+    sample_size: int = AUTO_K_SAMPLE_SIZE,
+    random_state: int = 42,
+) -> Tuple[int, np.ndarray]:
+    """
+    Chooses the number of clusters maximizing the silhouette score.
+
+    Every candidate from 2 to `max_clusters` is clustered on all the points, but scored on a
+    sample of at most `sample_size` points, as the silhouette is quadratic in the number of points.
+
+    Returns:
+        Tuple containing the chosen number of clusters and the labels of the points.
+    """
+    max_clusters = min(max_clusters, len(points) - 1)
+    if max_clusters < 2:
+        return 1, np.zeros(len(points), dtype=np.intp)
+
+    best: Optional[Tuple[float, int, np.ndarray]] = None
+    for n_clusters in range(2, max_clusters + 1):
+        labels = engine(points, n_clusters, random_state)
+        if len(np.unique(labels)) < 2:
+            continue
+        score = silhouette_score(points, labels, sample_size=min(sample_size, len(points)), random_state=random_state)
+        if best is None or score > best[0]:
+            best = (score, n_clusters, labels)
+
+    if best is None:
+        return 1, np.zeros(len(points), dtype=np.intp)
+    return best[1], best[2]
+
+def group_by_label(labels: np.ndarray, keys: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Groups the indices of the points by label, without a pass over the points per label.
+
+    Args:
+        labels: Cluster label (a non-negative integer) for each point.
+        keys: If given, the indices are sorted by ascending key within each group, ties keeping
+            their original order.
+
+    Returns:
+        Tuple containing:
+            - the indices of the points, grouped by ascending label
+            - the offsets of the groups in the indices, such that the points of label `l` are
+              `indices[offsets[l]:offsets[l + 1]]`
+    """
+    order = np.argsort(labels, kind='stable') if keys is None else np.lexsort((keys, labels))
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels))))
+    return order, offsets
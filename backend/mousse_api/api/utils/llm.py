@@ -4,9 +4,16 @@ import json
 import httpx
 import asyncio
 import contextlib
+from functools import lru_cache
+from typing import Any, Awaitable, Callable
 from fastapi import Request
 from json_repair import repair_json
 from pydantic import BaseModel
+from mousse_api.api.utils import metrics
+
+LLM_GUIDED_DECODING = os.getenv("LLM_GUIDED_DECODING", "true").lower() in ("1", "true", "yes")
+
+early_stop_metric = metrics.counter("llm_stream_early_stops", "Number of streamed completions stopped as soon as a valid JSON was produced")
 
 class ClientDisconnectedError(Exception):
     """Custom exception for client disconnections."""
@@ -21,48 +28,93 @@ class LLMException(Exception):
         self.detail = detail
         super().__init__(f"LLMException {status_code}: {detail}")
 
-async def chat_completion(query: str, system_prompt: str, request: Request, max_tokens: int = 128, temperature: float = 0) -> str:
-    url = "{chat_completion_url}/v1/chat/completions".format(
-        chat_completion_url=os.getenv("CHAT_COMPLETION_URL")
+@lru_cache(maxsize=None)
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Creates and caches the process-wide HTTP client for the chat completion server.
+
+    The client keeps its connections alive, so that consecutive (and retried) completions
+    reuse them instead of opening a new connection each time.
+
+    Environment Variables:
+        - LLM_MAX_CONNECTIONS: Maximum number of concurrent connections (default: 32).
+        - LLM_MAX_KEEPALIVE_CONNECTIONS: Maximum number of idle connections kept alive (default: 16).
+        - LLM_KEEPALIVE_EXPIRY: Time an idle connection is kept alive in seconds (default: 60).
+        - LLM_TIMEOUT: Timeout of a completion in seconds (default: 120).
+
+    Returns:
+        httpx.AsyncClient: The HTTP client instance.
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", 32)),
+            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 16)),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60)),
+        ),
+        timeout=httpx.Timeout(float(os.getenv("LLM_TIMEOUT", 120)), connect=5.0),
     )
-    model = os.getenv('LLM_MODEL')
-    payload = {
-        "model": model,
+
+async def close_http_client() -> None:
+    """Closes the process-wide HTTP client, if it has been created."""
+    if get_http_client.cache_info().currsize > 0:
+        await get_http_client().aclose()
+        get_http_client.cache_clear()
+
+def _payload(query: str, system_prompt: str, max_tokens: int, temperature: float, response_format: dict | None = None, **kwargs) -> dict:
+    if response_format is not None:
+        kwargs["response_format"] = response_format
+    return {
+        "model": os.getenv('LLM_MODEL'),
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": query},
         ],
         "max_tokens": max_tokens,
         "temperature": temperature,
+        **kwargs,
     }
 
-    headers = { 'Content-Type': 'application/json' }
-
-    async with httpx.AsyncClient() as client:
-        task = asyncio.create_task(
-            client.post(url, headers=headers, json=payload, timeout=120)
-        )
-        async def monitor_disconnection():
-            try:
-                while True:
-                    message = await request.receive()
-                    if message['type'] == 'http.disconnect':
-                        break
-                task.cancel()
-            except asyncio.CancelledError:
-                pass
-        disconnect_task = asyncio.create_task(monitor_disconnection())
+async def _cancel_on_disconnect(coro: Awaitable[Any], request: Request | None) -> Any:
+    """
+    Awaits a coroutine, cancelling it if the client of the request disconnects in the meantime.
 
+    Raises:
+        ClientDisconnectedError: If the client disconnected.
+    """
+    task = asyncio.ensure_future(coro)
+    async def monitor_disconnection():
         try:
-            response = await task
+            while True:
+                message = await request.receive()
+                if message['type'] == 'http.disconnect':
+                    break
+            task.cancel()
         except asyncio.CancelledError:
-            raise ClientDisconnectedError("Client disconnected before request completion.")
-        finally:
+            pass
+    # Without a request, the completion is not bound to a client and is never cancelled
+    disconnect_task = asyncio.create_task(monitor_disconnection()) if request is not None else None
+
+    try:
+        return await task
+    except asyncio.CancelledError:
+        raise ClientDisconnectedError("Client disconnected before request completion.")
+    finally:
+        if disconnect_task is not None:
             disconnect_task.cancel()
             with contextlib.suppress(asyncio.CancelledError):
                 await disconnect_task
 
-        response = response.json()
+async def chat_completion(query: str, system_prompt: str, request: Request | None, max_tokens: int = 128, temperature: float = 0, response_format: dict | None = None) -> str:
+    url = "{chat_completion_url}/v1/chat/completions".format(
+        chat_completion_url=os.getenv("CHAT_COMPLETION_URL")
+    )
+    payload = _payload(query, system_prompt, max_tokens, temperature, response_format)
+
+    headers = { 'Content-Type': 'application/json' }
+
+    client = get_http_client()
+    response = await _cancel_on_disconnect(client.post(url, headers=headers, json=payload), request)
+    response = response.json()
 
     try:
         markdown_string = response['choices'][0]['message']['content']
@@ -71,56 +123,187 @@ async def chat_completion(query: str, system_prompt: str, request: Request, max_
 
     return markdown_string
 
+class JSONScanner:
+    """
+    Incrementally finds the end of the first complete top-level JSON object (or array) in a stream of text.
+
+    Text before the first opening bracket (e.g. a markdown fence) is skipped. Brackets within
+    strings are ignored.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.start = None
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> str | None:
+        """
+        Appends a chunk of text.
+
+        Returns:
+            str | None: The first complete JSON value not returned yet, if any.
+        """
+        self.text += chunk
+        while self._position < len(self.text):
+            char = self.text[self._position]
+            self._position += 1
+            if self.start is None:
+                if char in '{[':
+                    self.start = self._position - 1
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    value, self.start = self.text[self.start:self._position], None
+                    return value
+        return None
+
+async def stream_chat_completion(
+    query: str,
+    system_prompt: str,
+    request: Request | None,
+    max_tokens: int = 128,
+    temperature: float = 0,
+    response_format: dict | None = None,
+    validate: Callable[[str], bool] | None = None,
+) -> str:
+    """
+    Streams a chat completion, stopping the generation as soon as a complete and valid JSON value has been produced.
+
+    Args:
+        query (str): The input query for the LLM.
+        system_prompt (str): The system prompt to guide the LLM's response.
+        request (Request | None): The FastAPI request object, used to cancel the request when the client disconnects.
+        max_tokens (int): Maximum number of generated tokens.
+        temperature (float): Sampling temperature.
+        response_format (dict, optional): A constraint on the generated output, e.g. a JSON schema.
+        validate (Callable, optional): Checks whether a complete JSON value is acceptable. If None, the first one is.
+
+    Returns:
+        str: The first acceptable JSON value, or the whole generated text if there is none.
+    """
+    url = "{chat_completion_url}/v1/chat/completions".format(
+        chat_completion_url=os.getenv("CHAT_COMPLETION_URL")
+    )
+    payload = _payload(query, system_prompt, max_tokens, temperature, response_format, stream=True)
+
+    async def consume() -> str:
+        scanner = JSONScanner()
+        async with get_http_client().stream("POST", url, json=payload) as response:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    content = json.loads(data)['choices'][0]['delta'].get('content') or ""
+                except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+                    continue
+                value = scanner.feed(content)
+                if value is not None and (validate is None or validate(value)):
+                    # Leaving the stream closes the connection, which stops the generation
+                    early_stop_metric.inc()
+                    return value
+        return scanner.text
+
+    return await _cancel_on_disconnect(consume(), request)
+
 def _extract_json(markdown_string: str) -> str:
     json_match = re.search(r"```json\n(.*?)\n```", markdown_string, re.DOTALL)
     if not json_match:
         raise JSON_NOT_FOUND
     return json_match.group(1)
 
-async def llm_request(query: str, system_prompt: str, request: Request, PydanticModel: BaseModel, max_requests: int = 3, **kwargs):
+def _parse_response(markdown_string: str, PydanticModel: BaseModel) -> BaseModel:
+    try:
+        json_string = _extract_json(markdown_string)
+    except JSON_NOT_FOUND:
+        safe_json = repair_json(markdown_string)
+    else:
+        safe_json = repair_json(json_string)
+    llm_result = json.loads(safe_json)
+    # Handle cases where the LLM returns a list of dictionaries
+    # and we want to convert it to a single dictionary
+    if isinstance(llm_result, list):
+        dict_result = {}
+        for item in llm_result:
+            if isinstance(item, dict):
+                dict_result.update(item)
+        llm_result = dict_result
+    return PydanticModel(**llm_result)
+
+def _is_valid_response(json_string: str, PydanticModel: BaseModel) -> bool:
+    try:
+        PydanticModel(**json.loads(json_string))
+    except Exception:
+        return False
+    return True
+
+async def llm_request(query: str, system_prompt: str, request: Request, PydanticModel: BaseModel, max_requests: int = 3, stream: bool = False, guided: bool = LLM_GUIDED_DECODING, **kwargs):
     """
     Function to handle LLM requests with retries and error handling.
     
     Args:
         query (str): The input query for the LLM.
         system_prompt (str): The system prompt to guide the LLM's response.
-        request (Request): The FastAPI request object.
+        request (Request | None): The FastAPI request object, used to cancel the request when the client disconnects.
         PydanticModel (BaseModel): The Pydantic model to validate the LLM's response.
         max_requests (int): Maximum number of retries for the request.
+        stream (bool): Whether to stream the completion, stopping the generation as soon as a valid JSON has been produced.
+        guided (bool): Whether to constrain the generation to the JSON schema of the Pydantic model,
+            so that parsing and repairing the output are fallbacks only. Enabled unless `LLM_GUIDED_DECODING` is false.
         **kwargs: Additional arguments for the chat completion function.
     """
+    name = PydanticModel.__name__
+    requests_metric = metrics.counter(f"llm_{name}_requests", f"Number of {name} LLM requests")
+    attempts_metric = metrics.counter(f"llm_{name}_attempts", f"Number of {name} completions, including retries")
+    failures_metric = metrics.counter(f"llm_{name}_failures", f"Number of {name} LLM requests without a valid response after all retries")
+    requests_metric.inc()
+    if guided:
+        kwargs.setdefault("response_format", {"type": "json", "value": PydanticModel.model_json_schema()})
+
     success = False
     retries = 0
     while not success and retries < max_requests:
+        attempts_metric.inc()
         try:
-            markdown_string = await chat_completion(query, system_prompt, request, **kwargs)
+            if stream:
+                markdown_string = await stream_chat_completion(
+                    query, system_prompt, request,
+                    validate=lambda json_string: _is_valid_response(json_string, PydanticModel),
+                    **kwargs,
+                )
+            else:
+                markdown_string = await chat_completion(query, system_prompt, request, **kwargs)
         except ClientDisconnectedError as e:
             raise LLMException(status_code=400, detail=str(e))
         except RuntimeError as e:
             raise LLMException(status_code=503, detail=str(e))
         try:
-            try:
-                json_string = _extract_json(markdown_string)
-            except JSON_NOT_FOUND:
-                safe_json = repair_json(markdown_string)
-            else:
-                safe_json = repair_json(json_string)
-            llm_result = json.loads(safe_json)
-            # Handle cases where the LLM returns a list of dictionaries
-            # and we want to convert it to a single dictionary
-            if isinstance(llm_result, list):
-                dict_result = {}
-                for item in llm_result:
-                    if isinstance(item, dict):
-                        dict_result.update(item)
-                llm_result = dict_result
-            llm_result = PydanticModel(**llm_result)
+            llm_result = _parse_response(markdown_string, PydanticModel)
         except Exception as e:
             retries += 1
         else:
             success = True
     
     if not success:
+        failures_metric.inc()
         raise LLMException(status_code=503, detail="LLM did not return a meaningful response")
 
     return llm_result
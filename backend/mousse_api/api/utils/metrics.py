@@ -0,0 +1,73 @@
+import os
+import threading
+
+class Counter:
+    """
+    Monotonically increasing counter.
+
+    Attributes:
+        description (str): Human readable description of the counter.
+        value (int): Current value of the counter.
+    """
+
+    def __init__(self, description: str):
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> dict:
+        return {'description': self.description, 'value': self.value}
+
+class Summary:
+    """
+    Aggregates observations of a value (count, sum, min, max and mean).
+
+    Attributes:
+        description (str): Human readable description of the observed value.
+    """
+
+    def __init__(self, description: str):
+        self.description = description
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self) -> dict:
+        return {
+            'description': self.description,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+        }
+
+_registry: dict[str, Counter | Summary] = {}
+
+def counter(name: str, description: str = "") -> Counter:
+    """Returns the counter registered under `name`, creating it if needed."""
+    return _registry.setdefault(name, Counter(description))
+
+def summary(name: str, description: str = "") -> Summary:
+    """Returns the summary registered under `name`, creating it if needed."""
+    return _registry.setdefault(name, Summary(description))
+
+def snapshot() -> dict:
+    """Returns the current state of all the metrics of this worker process."""
+    return {
+        'pid': os.getpid(),
+        'metrics': {name: metric.snapshot() for name, metric in sorted(_registry.items())},
+    }
@@ -0,0 +1,65 @@
+import base64
+import binascii
+import hashlib
+import json
+import math
+from uuid import UUID
+from mousse_api.api.schemata.records import MinimumSearchBody, SearchBody
+from mousse_api.api.utils.cache import generate_query_hash
+
+def search_fingerprint(body: SearchBody) -> str:
+    """
+    Computes a fingerprint of the parts of a search that determine the ranking of the results,
+    i.e. the query, the filters and the threshold.
+
+    Args:
+        body (SearchBody): The search request.
+
+    Returns:
+        str: The fingerprint of the search.
+    """
+    minimum = MinimumSearchBody.model_validate(body.model_dump(include=set(MinimumSearchBody.model_fields)))
+    return hashlib.sha256(f"{generate_query_hash(minimum)}:{body.threshold}".encode()).hexdigest()[:16]
+
+def encode_cursor(fingerprint: str, page: int, offset: int, distance: float, uuid: str) -> str:
+    """
+    Encodes an opaque cursor pointing right after the given result.
+
+    Args:
+        fingerprint (str): The fingerprint of the search, as returned by `search_fingerprint`.
+        page (int): The number of the page the cursor leads to.
+        offset (int): The rank of the first result of that page.
+        distance (float): The cosine distance of the last result served.
+        uuid (str): The uuid of the last result served.
+
+    Returns:
+        str: The URL-safe cursor.
+    """
+    payload = json.dumps({"f": fingerprint, "p": page, "o": offset, "d": distance, "u": str(uuid)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(cursor: str, fingerprint: str) -> tuple[int, int, float, str]:
+    """
+    Decodes a cursor returned by a previous search.
+
+    Args:
+        cursor (str): The cursor.
+        fingerprint (str): The fingerprint of the current search; it should match the one of the cursor.
+
+    Returns:
+        tuple[int, int, float, str]: The page number, the rank of its first result, and the distance
+            and uuid of the last result served.
+
+    Raises:
+        ValueError: If the cursor is malformed or was issued for a different search.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        page, offset, distance, uuid = int(payload["p"]), int(payload["o"]), float(payload["d"]), str(UUID(payload["u"]))
+    except (binascii.Error, ValueError, TypeError, KeyError, AttributeError) as e:
+        raise ValueError("Malformed cursor") from e
+    if page < 1 or offset < 0 or not math.isfinite(distance):
+        raise ValueError("Malformed cursor")
+    if payload.get("f") != fingerprint:
+        raise ValueError("The cursor does not belong to this search")
+    return page, offset, distance, uuid
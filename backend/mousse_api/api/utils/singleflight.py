@@ -0,0 +1,94 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from valkey.exceptions import ValkeyError
+
+from mousse_api.logger import logger
+from mousse_api.valkey_client import get_valkey_client
+from mousse_api.api.utils.cache import acquire_lock, release_lock
+from mousse_api.api.utils import metrics
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight computations, so that they run once and share their result.
+
+    Works at two levels:
+        - In-process: concurrent calls with the same key, within the worker, await the same task.
+        - Across workers: if the caller knows how to `load` the result from a shared cache, the
+          computation runs under a Valkey lock, and the other workers poll the cache until the
+          holder has stored the result there (which is up to the computation itself). If the lock
+          expires, or Valkey is unavailable, the result is computed anyway.
+
+    The number of executed and deduplicated computations are exported as metrics, prefixed with `name`.
+
+    Attributes:
+        name (str): The name of the computation, used for the lock keys and the metrics.
+        lock_ttl (float): Time (in seconds) after which a lock is considered abandoned.
+        poll_interval (float): Time (in seconds) between two polls of the shared cache.
+    """
+
+    def __init__(self, name: str, lock_ttl: float = 60, poll_interval: float = 0.1):
+        self.name = name
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._executed = metrics.counter(f"singleflight_{name}_executed", f"Number of {name} computations executed")
+        self._coalesced = metrics.counter(f"singleflight_{name}_coalesced", f"Number of {name} requests that joined a computation in flight in the same worker")
+        self._waited = metrics.counter(f"singleflight_{name}_waited", f"Number of {name} requests served by the computation of another worker")
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], load: Callable[[], Awaitable[Any]] | None = None) -> Any:
+        """
+        Runs `fn`, unless an identical computation is already in flight.
+
+        Args:
+            key (str): The fingerprint of the computation.
+            fn (Callable): A coroutine function performing the computation.
+            load (Callable, optional): A coroutine function reading the result of the computation from a
+                shared cache, returning None if it is not there yet. Enables the coalescing across workers.
+
+        Returns:
+            The result of the computation.
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self._coalesced.inc()
+        else:
+            task = asyncio.ensure_future(self._run(key, fn, load))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # The computation outlives a cancelled caller, as other callers may be waiting for it
+        return await asyncio.shield(task)
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable[Any]], load: Callable[[], Awaitable[Any]] | None) -> Any:
+        if load is None:
+            self._executed.inc()
+            return await fn()
+
+        valkey = get_valkey_client()
+        lock_key = f"singleflight:{self.name}:{key}"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_ttl
+        token = None
+        while loop.time() < deadline:
+            try:
+                token = await acquire_lock(valkey, lock_key, ttl_seconds=self.lock_ttl)
+            except ValkeyError as e:
+                logger.warning("Could not acquire %s lock: %s", self.name, e)
+                break
+            if token is not None:
+                break
+            # Another worker is computing the result
+            await asyncio.sleep(self.poll_interval)
+            result = await load()
+            if result is not None:
+                self._waited.inc()
+                return result
+
+        try:
+            self._executed.inc()
+            return await fn()
+        finally:
+            if token is not None:
+                try:
+                    await release_lock(valkey, lock_key, token)
+                except ValkeyError as e:
+                    logger.warning("Could not release %s lock: %s", self.name, e)
@@ -0,0 +1,26 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from mousse_api.db.models import Topic
+
+_topic_ids: dict[str, int] | None = None
+
+async def get_topic_ids(session: AsyncSession, topics: list[str]) -> list[int]:
+    """
+    Returns the ids of the given topics.
+
+    The topics are read once per process and served from memory afterwards. As topics keep being
+    added by the ingestion, the topics are read again when some of them are not known yet. Topics
+    still unknown are ignored, so the ids may be fewer than the topics (or none at all).
+
+    Args:
+        session (AsyncSession): The database session.
+        topics (list[str]): A list of topic labels.
+
+    Returns:
+        list[int]: The ids of the known topics.
+    """
+    global _topic_ids
+    if _topic_ids is None or any(topic not in _topic_ids for topic in topics):
+        result = await session.execute(select(Topic.topic, Topic.id))
+        _topic_ids = {topic: id for topic, id in result.all()}
+    return sorted({_topic_ids[topic] for topic in topics if topic in _topic_ids})
@@ -1,8 +1,30 @@
+import os
 import json
+import time
 from datetime import datetime
 import shapely
-from sqlalchemy import text, TextClause, bindparam, String, Date, Integer, Float
-from pgvector.sqlalchemy import Vector
+from sqlalchemy import text, TextClause, bindparam, String, Date, Integer, Float, LargeBinary, ARRAY, Uuid
+from mousse_api.db.types import Vector
+from sqlalchemy.ext.asyncio import AsyncSession
+from mousse_api.api.utils.helpers import months_to_mask
+
+PREFILTER_MAX_SELECTIVITY = float(os.getenv("PREFILTER_MAX_SELECTIVITY", 0.01))
+# Time (in seconds) the estimated number of embeddings is reused before being read again
+EMBEDDING_COUNT_TTL = 3600
+
+# Filters matching too many records for a 'prefilter' plan, when used on their own
+BROAD_FILTERS = {'epoch_filtered'}
+
+_embedding_count: tuple[float, float] | None = None
+
+async def _estimate_embedding_count(session: AsyncSession) -> float:
+    """Returns the number of embeddings estimated by the planner, read at most once per `EMBEDDING_COUNT_TTL` per process."""
+    global _embedding_count
+    now = time.monotonic()
+    if _embedding_count is None or now - _embedding_count[0] > EMBEDDING_COUNT_TTL:
+        total_rows = (await session.execute(text("SELECT reltuples FROM pg_class WHERE oid = 'core.embedding'::regclass"))).scalar()
+        _embedding_count = (now, float(total_rows or 0))
+    return _embedding_count[1]
 
 class SqlConstuctor():
     """
@@ -12,14 +34,35 @@ class SqlConstuctor():
     that filter records by geographic, temporal, or semantic criteria. The filters
     include country, spatial features, date ranges, epochs, and embeddings.
 
+    Two plans are supported for combining the filters with the semantic search:
+        - 'prefilter': The record sets matching each filter are intersected and the
+          semantic search is restricted to the intersection.
+        - 'postfilter': The filters are pushed into the ANN scan as correlated predicates,
+          evaluated against indexed tables while the index is traversed.
+
+    The predicates first check the filter attributes denormalized on `core.embedding`
+    (country codes, covered years, month mask and topics), so that most of the rows are
+    rejected without leaving the embedding row; the exact spatial and temporal checks
+    are only evaluated on the remaining candidates.
+
     Attributes:
         ctes (dict): Pre-defined SQL CTE templates.
+        predicates (dict): Pre-defined SQL templates of the filters as correlated predicates.
         parameters (dict): Parameters to be used in the SQL queries.
+        predicate_parameters (dict): Parameters used only by the correlated predicates.
         queries (dict): Built SQL queries for various topics.
+        filters (dict): Built SQL predicates for various topics.
+        strategy (str): The plan used to apply the filters, one of 'prefilter' or 'postfilter'.
+        after (tuple, optional): The distance and uuid of the last result of the previous page, for keyset pagination.
     """
 
     ctes = {
         'country': """
+            SELECT record_uuid
+            FROM core."location"
+            WHERE ST_Within(geometry, ST_GeomFromEWKB(%(geometry)s))
+        """,
+        'country_union': """
             SELECT record_uuid
             FROM core."location"
             WHERE ST_Within(
@@ -39,42 +82,44 @@ class SqlConstuctor():
         """,
         'epoch': """
             SELECT record_uuid
-            FROM (
-                SELECT 
-                    record_uuid,
-                    CASE 
-                        WHEN upper(time_interval) - lower(time_interval) >= '1 year'::interval THEN
-                            ARRAY(select generate_series(1, 12))
-                        ELSE
-                            ARRAY(
-                                SELECT EXTRACT(MONTH FROM d)::int
-                                FROM generate_series(
-                                    lower(time_interval)::date,
-                                    upper(time_interval)::date,
-                                    '1 month'
-                                ) AS d
-                            ) 
-                    END AS "month"
-                FROM core.record_time_range
-            ) AS extracted_months
-            WHERE array[%(month_list)s] && "month"
+            FROM core.record_time_range
+            WHERE (month_mask & %(month_mask)s) <> 0
+        """,
+        'topic': """
+            SELECT record_uuid
+            FROM core.record_topic
+            WHERE topic_id = ANY(%(topic_ids)s)
         """,
         'semantic': """
             SELECT record_uuid, vector <=> %(embedding)s AS distance
             FROM core.embedding
             WHERE record_uuid IN (SELECT record_uuid FROM ensemble)
+            AND %(keyset)s
             ORDER BY distance
             OFFSET %(offset)d LIMIT %(limit)d
         """,
         'semantic_solo': """
             SELECT record_uuid, vector <=> %(embedding)s AS distance
             FROM core.embedding
+            WHERE %(keyset)s
             ORDER BY distance
             OFFSET %(offset)d LIMIT %(limit)d
         """,
+        'semantic_hybrid': """
+            SELECT emb.record_uuid, emb.vector <=> %(embedding)s AS distance
+            FROM core.embedding emb
+            WHERE %(predicates)s
+            AND %(keyset)s
+            ORDER BY distance
+            OFFSET %(offset)d LIMIT %(limit)d
+        """,
+        'hydrate': """
+            SELECT record_uuid, distance
+            FROM unnest(CAST(%(uuids)s AS UUID[]), CAST(%(distances)s AS DOUBLE PRECISION[])) AS ranked(record_uuid, distance)
+        """,
         'records': """
             SELECT 
-                ROUND(1 - emb.distance::numeric, 4) AS score,
+                ROUND(1 - emb.distance::numeric, 4) AS score, emb.distance,
                 rec.uuid, rec.geoss_id AS original_id, rec.title, rec.description, rec.format, rec.keyword,
                 array_agg(topic.topic) AS topic,
                 loc.geometry
@@ -85,11 +130,55 @@ class SqlConstuctor():
             LEFT JOIN core.location loc ON loc.record_uuid = emb.record_uuid
             WHERE distance < %(maximum_distance)s
             GROUP BY rec."uuid", emb.distance, loc.geometry
-            ORDER BY distance
+            ORDER BY distance, rec."uuid"
         """
     }
 
-    def __init__(self, page: int = 1, threshold: float = 0.2, results_per_page: int = 10):
+    predicates = {
+        'country': """
+            emb.country_codes && CAST(%(country_codes)s AS VARCHAR(3)[])
+            AND EXISTS (
+                SELECT 1 FROM core."location" loc
+                WHERE loc.record_uuid = emb.record_uuid AND ST_Within(loc.geometry, ST_GeomFromEWKB(%(geometry)s))
+            )
+        """,
+        'country_union': """
+            emb.country_codes && CAST(%(country_codes)s AS VARCHAR(3)[])
+            AND EXISTS (
+                SELECT 1 FROM core."location" loc
+                WHERE loc.record_uuid = emb.record_uuid AND ST_Within(
+                    loc.geometry,
+                    (SELECT ST_MakeValid(ST_Simplify(ST_Union(geometry), 0.1)) FROM core.countries WHERE "code" IN (%(country_list)s))
+                )
+            )
+        """,
+        'features': """
+            EXISTS (
+                SELECT 1 FROM core."location" loc
+                WHERE loc.record_uuid = emb.record_uuid AND ST_Within(loc.geometry, ST_GeomFromText(%(wkt)s, 4326))
+            )
+        """,
+        'daterange': """
+            emb.coverage_years && int4range(%(start_year)s, %(end_year)s, '[]')
+            AND EXISTS (
+                SELECT 1 FROM core.record_time_range tr
+                WHERE tr.record_uuid = emb.record_uuid AND tr.time_interval && tstzrange(%(start)s, %(end)s, '[]')
+            )
+        """,
+        'epoch': """
+            (emb.month_mask & %(month_mask)s) <> 0
+        """,
+        'topic': """
+            emb.topic_ids && CAST(%(topic_ids)s AS INTEGER[])
+        """,
+        'keyset': """
+            (vector <=> %(embedding)s, record_uuid) > (%(distance)s, %(uuid)s)
+        """,
+    }
+
+    strategies = ('prefilter', 'postfilter')
+
+    def __init__(self, page: int = 1, threshold: float = 0.2, results_per_page: int = 10, strategy: str = 'prefilter', after: tuple[float, str] | None = None):
         """
         Initializes the SqlConstructor instance.
 
@@ -99,12 +188,22 @@ class SqlConstuctor():
             page (int, optional): The requested page of results. Defaults to 1.
             threshold (float, optional): The similarity score (1 - cosine distance) threshold. Defaults to 0.6.
             results_per_page (int, optional): The number of results per page. Defaults to 10.
+            strategy (str, optional): The plan used to apply the filters, one of 'prefilter' or 'postfilter'.
+                It can be chosen based on the selectivity of the filters with `choose_strategy`. Defaults to 'prefilter'.
+            after (tuple[float, str], optional): The distance and uuid of the last result of the previous page.
+                If given, the search resumes right after that result instead of skipping `page - 1` pages. Defaults to None.
         """
+        if strategy not in self.strategies:
+            raise ValueError(f"`strategy` should be one of {', '.join(self.strategies)}")
         self.parameters = []
+        self.predicate_parameters = []
         self.queries = {}
+        self.filters = {}
+        self.strategy = strategy
         self.page = page
         self.threshold = threshold
         self.results_per_page = results_per_page
+        self.after = after
     
     def _part(self, topic: str, **kwargs) -> str:
         """
@@ -123,6 +222,18 @@ class SqlConstuctor():
         if topic not in self.ctes:
             raise ValueError()
         return self.ctes[topic] % kwargs
+
+    def _add_filter(self, name: str, topic: str, **kwargs) -> None:
+        """
+        Registers a filter both as a CTE and as a correlated predicate.
+
+        Args:
+            name (str): The name of the CTE.
+            topic (str): The topic key of the CTE and predicate templates.
+            **kwargs: Named arguments to format the templates.
+        """
+        self.queries.update({name: self._part(topic, **kwargs)})
+        self.filters.update({name: self.predicates[topic] % kwargs})
     
     def add(self, topic: str, *args, **kwargs) -> None:
         """
@@ -130,7 +241,7 @@ class SqlConstuctor():
 
         Args:
             topic (str): The topic to add the filter for. Supported topics include:
-                'country', 'spatial', 'daterange', and 'epoch'.
+                'country', 'spatial', 'daterange', 'epoch', and 'topic'.
             *args: Positional arguments specific to the topic.
             **kwargs: Keyword arguments specific to the topic.
 
@@ -145,20 +256,29 @@ class SqlConstuctor():
             self._add_daterange_cte(*args, **kwargs)
         elif topic == 'epoch':
             self._add_epoch_cte(*args, **kwargs)
+        elif topic == 'topic':
+            self._add_topic_cte(*args, **kwargs)
         else:
             raise ValueError()
     
-    def _add_country_cte(self, country_list: list[str]) -> None:
+    def _add_country_cte(self, country_list: list[str], geometry: bytes | None = None) -> None:
         """
         Adds a country filter CTE to the query.
 
         Args:
             country_list (list[str]): A list of country codes to filter records by.
+            geometry (bytes, optional): The precomputed (EWKB) union of the country geometries,
+                as returned by `get_country_geometry`. If not given, the union is computed within the query.
         """
+        self.predicate_parameters.append(bindparam("country_codes", value=list(country_list), type_=ARRAY(String)))
+        if geometry is not None:
+            self.parameters.append(bindparam("country_geometry", value=geometry, type_=LargeBinary))
+            self._add_filter('country_filtered', 'country', geometry=':country_geometry', country_codes=':country_codes')
+            return
         for i, country in enumerate(country_list):
             self.parameters.append(bindparam(f"code_{i}", value=country, type_=String))
         placeholders = ", ".join(f":code_{i}" for i in range(len(country_list)))
-        self.queries.update({'country_filtered': self._part('country', country_list = placeholders)})
+        self._add_filter('country_filtered', 'country_union', country_list=placeholders, country_codes=':country_codes')
 
     def _add_spatial_cte(self, features: list) -> None:
         """
@@ -174,7 +294,7 @@ class SqlConstuctor():
         geojson = json.dumps(geojson)
         wkt = shapely.to_wkt(shapely.union_all(shapely.from_geojson(geojson)))
         self.parameters.append(bindparam("wkt", value=wkt, type_=String))
-        self.queries.update({'spatially_filtered': self._part('features', wkt=":wkt")})
+        self._add_filter('spatially_filtered', 'features', wkt=':wkt')
 
     def _add_daterange_cte(self, start_date: str, end_date: str) -> None:
         """
@@ -184,21 +304,36 @@ class SqlConstuctor():
             start_date (str): The start date in ISO format.
             end_date (str): The end date in ISO format.
         """
-        self.parameters.append(bindparam("start_date", value=datetime.strptime(start_date, '%Y-%m-%d').date(), type_=Date))
-        self.parameters.append(bindparam("end_date", value=datetime.strptime(end_date, '%Y-%m-%d').date(), type_=Date))
-        self.queries.update({'date_filtered': self._part('daterange', start=':start_date', end=':end_date')})
+        start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+        self.parameters.append(bindparam("start_date", value=start_date, type_=Date))
+        self.parameters.append(bindparam("end_date", value=end_date, type_=Date))
+        self.predicate_parameters.append(bindparam("start_year", value=start_date.year, type_=Integer))
+        self.predicate_parameters.append(bindparam("end_year", value=end_date.year, type_=Integer))
+        self._add_filter('date_filtered', 'daterange', start=':start_date', end=':end_date', start_year=':start_year', end_year=':end_year')
 
-    def _add_epoch_cte(self, months: list[str]) -> None:
+    def _add_epoch_cte(self, months: list[int]) -> None:
         """
         Adds an epoch filter CTE to the query.
 
+        The filter is applied on the precomputed month mask of the time ranges, which can be read with
+        an index-only scan of `ix_record_time_range_month_mask`.
+
+        Args:
+            months (list[int]): A list of month numbers to filter by.
+        """
+        self.parameters.append(bindparam("epoch_mask", value=months_to_mask(months), type_=Integer))
+        self._add_filter('epoch_filtered', 'epoch', month_mask=':epoch_mask')
+
+    def _add_topic_cte(self, topic_ids: list[int]) -> None:
+        """
+        Adds a topic filter CTE to the query.
+
         Args:
-            months (list[str]): A list of month numbers (as strings) to filter by.
+            topic_ids (list[int]): A list of topic ids to filter by.
         """
-        for i, month in enumerate(months):
-            self.parameters.append(bindparam(f"epoch_{i}", value=month, type_=Integer))
-        placeholders = ", ".join(f":epoch_{i}" for i in range(len(months)))
-        self.queries.update({'epoch_filtered': self._part('epoch', month_list=placeholders)})
+        self.parameters.append(bindparam("topic_ids", value=list(topic_ids), type_=ARRAY(Integer)))
+        self._add_filter('topic_filtered', 'topic', topic_ids=':topic_ids')
 
     def _add_ensemble_cte(self) -> bool:
         """
@@ -221,12 +356,69 @@ class SqlConstuctor():
 
         Args:
             embedding (list): A list of embedding values to search for similar records.
-            solo (bool, optional): If False, a WHERE statement will be added to apply the filters. Defaults to False.
+            solo (bool, optional): If False, the filters will be applied according to the chosen strategy. Defaults to False.
         """
-        cte_part = 'semantic_solo' if solo else 'semantic'
         self.parameters.append(bindparam("embedding", value=embedding, type_=Vector))
-        offset = (self.page - 1) * self.results_per_page
-        self.queries.update({'vector_search': self._part(cte_part, embedding=':embedding', offset=offset, limit=self.results_per_page + 1)})
+        limit = self.results_per_page + 1
+        if self.after is not None:
+            # Keyset pagination: resume after the last result served, instead of skipping the previous pages.
+            # The ANN index scan cannot seek on a distance floor, so the predicate is checked on top of it and
+            # the scan still walks the previous pages; deep pages are kept cheap by the cache of ranked windows.
+            self.parameters.append(bindparam("after_distance", value=self.after[0], type_=Float))
+            self.parameters.append(bindparam("after_uuid", value=self.after[1], type_=Uuid(as_uuid=False)))
+            keyset = self.predicates['keyset'] % dict(embedding=':embedding', distance=':after_distance', uuid=':after_uuid')
+            offset = 0
+        else:
+            keyset = "TRUE"
+            offset = (self.page - 1) * self.results_per_page
+        if solo:
+            cte = self._part('semantic_solo', embedding=':embedding', keyset=keyset, offset=offset, limit=limit)
+        elif self.strategy == 'postfilter':
+            # The filter CTEs are replaced by the correlated predicates
+            for name in [*self.filters, 'ensemble']:
+                self.queries.pop(name, None)
+            self.parameters.extend(self.predicate_parameters)
+            predicates = "\n AND ".join(self.filters.values())
+            cte = self._part('semantic_hybrid', embedding=':embedding', predicates=predicates, keyset=keyset, offset=offset, limit=limit)
+        else:
+            cte = self._part('semantic', embedding=':embedding', keyset=keyset, offset=offset, limit=limit)
+        self.queries.update({'vector_search': cte})
+
+    async def choose_strategy(self, session: AsyncSession, max_selectivity: float = PREFILTER_MAX_SELECTIVITY) -> str:
+        """
+        Chooses the plan for applying the filters, based on their estimated selectivity.
+
+        The number of records matching all the filters is estimated by the query planner and compared
+        with the number of embeddings. Selective filters (few matching records) are applied first
+        ('prefilter'), while broad ones are pushed into the ANN scan ('postfilter'), which stops
+        as soon as enough matching neighbors have been found. The estimation is skipped for filters
+        known to be broad (`BROAD_FILTERS`), and the number of embeddings is read once in a while only.
+
+        Should be called after adding all the filters and before creating the query.
+
+        Args:
+            session (AsyncSession): The database session.
+            max_selectivity (float, optional): Maximum ratio of matching records for a 'prefilter' plan.
+
+        Returns:
+            str: The chosen strategy.
+        """
+        if len(self.filters) == 0:
+            return self.strategy
+        if set(self.filters) <= BROAD_FILTERS:
+            # The plan is known without asking the planner
+            self.strategy = 'postfilter'
+            return self.strategy
+        predicates = "\n AND ".join(self.filters.values())
+        stmt = text(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM core.embedding emb WHERE {predicates}").bindparams(*self.parameters, *self.predicate_parameters)
+        plan = (await session.execute(stmt)).scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        estimated_rows = plan[0]['Plan']['Plan Rows']
+        total_rows = await _estimate_embedding_count(session)
+
+        selectivity = estimated_rows / total_rows if total_rows and total_rows > 0 else 1.0
+        self.strategy = 'prefilter' if selectivity <= max_selectivity else 'postfilter'
+        return self.strategy
 
     def _add_records_cte(self, maximum_distance: float) -> None:
         cte_part = 'records'
@@ -248,26 +440,86 @@ class SqlConstuctor():
         solo = not self._add_ensemble_cte()
         self._add_embedding_cte(embedding, solo)
         self._add_records_cte(1 - self.threshold)
+        return self._create_records(output)
+
+    def _create_records(self, output: str) -> TextClause:
         ctes = ",\n".join([f"{name} AS ({stmt})" for name, stmt in self.queries.items()])
-        select_stmt = "*" if output == 'json' else "ST_AsGeoJSON(records.*, id_column => 'uuid')"
+        select_stmt = "*" if output == 'json' else "ST_AsGeoJSON(records.*, id_column => 'uuid') AS feature, distance, uuid"
         stmt = f"""
             WITH {ctes}
             SELECT {select_stmt}
             FROM records
         """.strip()
         return text(stmt).bindparams(*self.parameters)
+
+    def create_ranking(self, embedding: list[float]) -> TextClause:
+        """
+        Creates a query returning only the ranking of the matching records, i.e. their uuids and distances,
+        including all specified filters.
+
+        Args:
+            embedding (list): A list of embedding values to search for similar records.
+
+        Returns:
+            sqlalchemy.TextClause: A SQLAlchemy TextClause object representing the final query.
+        """
+        solo = not self._add_ensemble_cte()
+        self._add_embedding_cte(embedding, solo)
+        self.parameters.append(bindparam("maximum_distance", value=1 - self.threshold, type_=Float))
+        ctes = ",\n".join([f"{name} AS ({stmt})" for name, stmt in self.queries.items()])
+        stmt = f"""
+            WITH {ctes}
+            SELECT record_uuid, distance
+            FROM vector_search
+            WHERE distance < :maximum_distance
+            ORDER BY distance, record_uuid
+        """.strip()
+        return text(stmt).bindparams(*self.parameters)
+
+    def create_hydration(self, ranked: list[tuple[str, float]], output: str = 'json') -> TextClause:
+        """
+        Creates a query returning the details of already ranked records, ignoring any filters.
+
+        Args:
+            ranked (list[tuple[str, float]]): The uuids and distances of the records, as returned by `create_ranking`.
+            output (str, optional): One of `json` or `geojson`. Defaults to `json`.
+
+        Returns:
+            sqlalchemy.TextClause: A SQLAlchemy TextClause object representing the final query.
+        """
+        if output != 'json' and output != 'geojson':
+            raise ValueError("`output` should be one of `json` or `geojson`")
+        self.parameters.append(bindparam("uuids", value=[uuid for uuid, _ in ranked], type_=ARRAY(Uuid(as_uuid=False))))
+        self.parameters.append(bindparam("distances", value=[distance for _, distance in ranked], type_=ARRAY(Float)))
+        self.queries = {'vector_search': self._part('hydrate', uuids=':uuids', distances=':distances')}
+        self._add_records_cte(1 - self.threshold)
+        return self._create_records(output)
     
     def create_clustering(self, embedding: list[float]) -> TextClause:
+        """
+        Creates the query of the records to cluster, with their projection.
+
+        Only the columns needed for clustering are selected. The projection is read through the
+        binary codec of pgvector, as a NumPy array.
+
+        Args:
+            embedding (list): A list of embedding values to search for similar records.
+
+        Returns:
+            sqlalchemy.TextClause: A SQLAlchemy TextClause object representing the query.
+        """
         solo = not self._add_ensemble_cte()
         self._add_embedding_cte(embedding, solo)
-        self._add_records_cte(1 - self.threshold)
+        self.parameters.append(bindparam("maximum_distance", value=1 - self.threshold, type_=Float))
         ctes = ",\n".join([f"{name} AS ({stmt})" for name, stmt in self.queries.items()])
         stmt = f"""
             WITH {ctes}
             SELECT
-                records.uuid, records.title, records.score, to_json(lower_dim.vector) AS vector
-            FROM records
-            JOIN core.lower_dim
-            ON core.lower_dim.record_uuid = records.uuid
+                rec.uuid, rec.title, ROUND(1 - emb.distance::numeric, 4) AS score, lower_dim.vector
+            FROM vector_search emb
+            JOIN core.record rec ON rec."uuid" = emb.record_uuid
+            JOIN core.lower_dim ON core.lower_dim.record_uuid = emb.record_uuid
+            WHERE emb.distance < :maximum_distance
+            ORDER BY emb.distance, rec."uuid"
         """.strip()
         return text(stmt).bindparams(*self.parameters)
@@ -0,0 +1,42 @@
+import time
+import numpy as np
+from mousse_api.api.utils.kmeans import ENGINES, choose_n_clusters
+
+def _inertia(points: np.ndarray, labels: np.ndarray) -> float:
+    counts = np.bincount(labels)
+    centers = np.zeros((len(counts), points.shape[1]))
+    np.add.at(centers, labels, points)
+    centers /= np.maximum(counts, 1)[:, None]
+    return float(np.square(points - centers[labels]).sum() / len(points))
+
+def benchmark_clustering(sizes: list[int], n_clusters: int, dimensions: int, repeat: int, auto_k: bool) -> list[dict]:
+    """
+    Times the clustering engines on synthetic projections.
+
+    The projections are drawn from many overlapping blobs, so that, as with real embeddings,
+    the clusters are not well separated and K-means needs many iterations to converge.
+
+    Returns:
+        list[dict]: The best time (in seconds) and the mean squared distance of the points to
+            their cluster center (inertia), per size and engine.
+    """
+    # Only needed here, so that the other commands of the CLI do not pay for its import
+    from sklearn.datasets import make_blobs
+
+    results = []
+    for size in sizes:
+        points, _ = make_blobs(
+            n_samples=size, n_features=dimensions, centers=30, cluster_std=6.0, center_box=(-5, 5), random_state=0
+        )
+        points = points.astype(np.float32)
+        for name, engine in ENGINES.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                if auto_k:
+                    _, labels = choose_n_clusters(points, engine)
+                else:
+                    labels = engine(points, n_clusters, 42)
+                timings.append(time.perf_counter() - start)
+            results.append(dict(size=size, engine=name, seconds=min(timings), inertia=_inertia(points, labels)))
+    return results
@@ -4,6 +4,7 @@ from tqdm import tqdm
 import asyncio
 from .ingest import ingest
 from .ingest_lower_dim import ingest_lower_dim
+from .benchmark import benchmark_clustering
 
 @click.group()
 def cli() -> None:
@@ -39,3 +40,15 @@ def lower_dim(path: str) -> None:
     """
     files = [os.path.join(path, file) for file in os.listdir(path)] if os.path.isdir(path) else [path]
     asyncio.run(async_bulk_ingest_lower_dim(files))
+
+@cli.command()
+@click.option('--size', 'sizes', type=int, multiple=True, default=[1000, 10000, 100000], show_default=True, help='Number of points (repeatable)')
+@click.option('--clusters', type=int, default=8, show_default=True, help='Number of clusters')
+@click.option('--dimensions', type=int, default=81, show_default=True, help='Dimensions of the projections')
+@click.option('--repeat', type=int, default=3, show_default=True, help='Runs per engine, the best one is reported')
+@click.option('--auto-k', is_flag=True, help='Choose the number of clusters automatically')
+def cluster_benchmark(sizes: tuple[int], clusters: int, dimensions: int, repeat: int, auto_k: bool) -> None:
+    """Benchmark the clustering engines on synthetic projections"""
+    click.echo(f"{'size':>8} {'engine':<10} {'seconds':>9} {'inertia':>10}")
+    for result in benchmark_clustering(list(sizes), clusters, dimensions, repeat, auto_k):
+        click.echo(f"{result['size']:>8} {result['engine']:<10} {result['seconds']:>9.3f} {result['inertia']:>10.2f}")
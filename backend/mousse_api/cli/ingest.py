@@ -10,10 +10,10 @@ import shapely
 from shapely.ops import transform
 from shapely.geometry import Polygon, Point, Polygon
 from geoalchemy2 import WKTElement, Geometry
-from sqlalchemy import text
+from sqlalchemy import text, bindparam, SmallInteger
 from sqlalchemy.dialects.postgresql import UUID, ARRAY, VARCHAR, ENUM, TSTZRANGE, JSON
 import sqlalchemy.ext.asyncio
-from pgvector.sqlalchemy import Vector
+from mousse_api.db.types import Vector
 from mousse_api.db import get_session
 from mousse_api.logger import getLogger
 
@@ -48,6 +48,7 @@ def _ingest_all(df: pd.DataFrame, con: sqlalchemy.ext.asyncio.AsyncConnection) -
     _ingest_raw(df, con)
     _ingest_geom(df, con)
     _ingest_embedding(df, con)
+    _ingest_embedding_filters(df, con)
 
 def _ingest_record(df: pd.DataFrame, con: sqlalchemy.ext.asyncio.AsyncConnection) -> None:
     df_record = df[['uuid', 'id', 'title', 'description', 'format', 'type', 'keyword']].rename(columns={'id': 'geoss_id'})
@@ -59,6 +60,16 @@ def _ingest_record(df: pd.DataFrame, con: sqlalchemy.ext.asyncio.AsyncConnection
     }
     df_record.to_sql('record', con, schema='core', if_exists='append', index=False, method='multi', dtype=dtype_mapping)
 
+def _month_mask(start: pd.Timestamp, end: pd.Timestamp) -> int:
+    """12-bit mask of the months (bit 0 for January) covered by the interval [start, end]."""
+    span = (end.year - start.year) * 12 + end.month - start.month
+    if span >= 11:
+        return 0xFFF
+    mask = 0
+    for i in range(span + 1):
+        mask |= 1 << ((start.month - 1 + i) % 12)
+    return mask
+
 def _ingest_tr(df: pd.DataFrame, con: sqlalchemy.ext.asyncio.AsyncConnection) -> None:
     tr_mask = df[['uuid', 'when']].notnull()['when']
     df_record_tr = df[['uuid', 'when']][tr_mask].explode('when')
@@ -68,11 +79,13 @@ def _ingest_tr(df: pd.DataFrame, con: sqlalchemy.ext.asyncio.AsyncConnection) ->
     df_record_tr['to'] = pd.to_datetime(df_record_tr['to'], utc=True, errors='coerce')
     df_record_tr = df_record_tr[(df_record_tr.notnull()['from']) * (df_record_tr.notnull()['to'])]
     df_record_tr['time_interval'] = df_record_tr.apply(lambda e: (e['from'], e['to']) if e['from'] <= e['to'] else (e['to'], e['from']), axis=1)
-    df_record_tr = df_record_tr[['uuid', 'time_interval']].rename(columns={'uuid': 'record_uuid'})
+    df_record_tr['month_mask'] = df_record_tr.apply(lambda e: _month_mask(*e['time_interval']), axis=1)
+    df_record_tr = df_record_tr[['uuid', 'time_interval', 'month_mask']].rename(columns={'uuid': 'record_uuid'})
 
     dtype_mapping = {
         'record_uuid': UUID(),
         'time_interval': TSTZRANGE,
+        'month_mask': SmallInteger(),
     }
 
     df_record_tr.to_sql('record_time_range', con, schema='core', if_exists='append', index=False, method='multi', dtype=dtype_mapping)
@@ -189,5 +202,38 @@ def _ingest_embedding(df: pd.DataFrame, con: sqlalchemy.ext.asyncio.AsyncConnect
     }
     df_embedding.to_sql('embedding', con, schema='core', if_exists='append', index=False, method='multi', dtype=dtype_mapping)
 
+def _ingest_embedding_filters(df: pd.DataFrame, con: sqlalchemy.ext.asyncio.AsyncConnection) -> None:
+    """Denormalizes the search filter attributes of the ingested records into `core.embedding`."""
+    con.execute(text("""
+        UPDATE core.embedding emb
+        SET
+            country_codes = COALESCE((
+                SELECT array_agg(DISTINCT c.code ORDER BY c.code)
+                FROM core."location" loc
+                JOIN core.countries c ON ST_DWithin(loc.geometry, c.geometry, 0.1)
+                WHERE loc.record_uuid = emb.record_uuid
+            ), '{}'),
+            coverage_years = (
+                SELECT CASE WHEN count(*) > 0 THEN int4range(
+                    CASE WHEN NOT bool_or(lower_inf(tr.time_interval)) THEN min(EXTRACT(YEAR FROM lower(tr.time_interval)))::int END,
+                    CASE WHEN NOT bool_or(upper_inf(tr.time_interval)) THEN max(EXTRACT(YEAR FROM upper(tr.time_interval)))::int END,
+                    '[]'
+                ) END
+                FROM core.record_time_range tr
+                WHERE tr.record_uuid = emb.record_uuid
+            ),
+            month_mask = COALESCE((
+                SELECT bit_or(tr.month_mask)
+                FROM core.record_time_range tr
+                WHERE tr.record_uuid = emb.record_uuid
+            ), 0),
+            topic_ids = COALESCE((
+                SELECT array_agg(rt.topic_id ORDER BY rt.topic_id)
+                FROM core.record_topic rt
+                WHERE rt.record_uuid = emb.record_uuid
+            ), '{}')
+        WHERE emb.record_uuid = ANY(:uuids)
+    """).bindparams(bindparam('uuids', value=df['uuid'].tolist(), type_=ARRAY(UUID(as_uuid=False)))))
+
 if __name__ == '__main__':
     asyncio.run(ingest(sys.argv[1]))
@@ -3,7 +3,7 @@ import pyarrow.parquet as pq
 import pandas as pd
 import sqlalchemy.ext.asyncio
 from sqlalchemy.dialects.postgresql import UUID, TEXT
-from pgvector.sqlalchemy import Vector
+from mousse_api.db.types import Vector
 from mousse_api.db import get_session
 
 CHUNKSIZE = 1000
@@ -1,7 +1,8 @@
 import os
 from functools import lru_cache
 from typing import AsyncGenerator
-from sqlalchemy import MetaData
+from pgvector.asyncpg import register_vector
+from sqlalchemy import MetaData, event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -15,10 +16,21 @@ DB_URI = os.getenv("DB_URI")
 def get_engine() -> AsyncEngine:
     """
     Creates and caches an asynchronous SQLAlchemy engine.
+
+    Every connection registers the binary codec of pgvector, so that vectors are sent and read
+    in binary form, and read as NumPy arrays. Vectors should thus be bound with
+    `mousse_api.db.types.Vector`.
+
     Returns:
         AsyncEngine: SQLAlchemy AsyncEngine instance.
     """
-    return create_async_engine(DB_URI, pool_pre_ping=True, pool_size=10, max_overflow=20)
+    engine = create_async_engine(DB_URI, pool_pre_ping=True, pool_size=10, max_overflow=20)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def register_vector_codec(dbapi_connection, connection_record):
+        dbapi_connection.run_async(register_vector)
+
+    return engine
 
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     """
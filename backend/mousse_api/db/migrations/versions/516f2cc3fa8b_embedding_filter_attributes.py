@@ -0,0 +1,69 @@
+"""Embedding filter attributes
+
+Revision ID: 516f2cc3fa8b
+Revises: 73ebe86a8d96
+Create Date: 2026-10-18 12:31:52.640178
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '516f2cc3fa8b'
+down_revision = '73ebe86a8d96'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('embedding', sa.Column('country_codes', postgresql.ARRAY(sa.VARCHAR(length=3)), server_default='{}', nullable=False), schema='core')
+    op.add_column('embedding', sa.Column('coverage_years', postgresql.INT4RANGE(), nullable=True), schema='core')
+    op.add_column('embedding', sa.Column('month_mask', sa.SmallInteger(), server_default='0', nullable=False), schema='core')
+    op.add_column('embedding', sa.Column('topic_ids', postgresql.ARRAY(sa.Integer()), server_default='{}', nullable=False), schema='core')
+
+    # Backfill the filter attributes from the normalized tables
+    op.execute("""
+        UPDATE core.embedding emb
+        SET
+            country_codes = COALESCE((
+                SELECT array_agg(DISTINCT c.code ORDER BY c.code)
+                FROM core."location" loc
+                JOIN core.countries c ON ST_DWithin(loc.geometry, c.geometry, 0.1)
+                WHERE loc.record_uuid = emb.record_uuid
+            ), '{}'),
+            coverage_years = (
+                SELECT CASE WHEN count(*) > 0 THEN int4range(
+                    CASE WHEN NOT bool_or(lower_inf(tr.time_interval)) THEN min(EXTRACT(YEAR FROM lower(tr.time_interval)))::int END,
+                    CASE WHEN NOT bool_or(upper_inf(tr.time_interval)) THEN max(EXTRACT(YEAR FROM upper(tr.time_interval)))::int END,
+                    '[]'
+                ) END
+                FROM core.record_time_range tr
+                WHERE tr.record_uuid = emb.record_uuid
+            ),
+            month_mask = COALESCE((
+                SELECT bit_or(tr.month_mask)
+                FROM core.record_time_range tr
+                WHERE tr.record_uuid = emb.record_uuid
+            ), 0),
+            topic_ids = COALESCE((
+                SELECT array_agg(rt.topic_id ORDER BY rt.topic_id)
+                FROM core.record_topic rt
+                WHERE rt.record_uuid = emb.record_uuid
+            ), '{}')
+    """)
+
+    op.create_index('ix_embedding_country_codes', 'embedding', ['country_codes'], unique=False, schema='core', postgresql_using='gin')
+    op.create_index('ix_embedding_coverage_years', 'embedding', ['coverage_years'], unique=False, schema='core', postgresql_using='gist')
+    op.create_index('ix_embedding_topic_ids', 'embedding', ['topic_ids'], unique=False, schema='core', postgresql_using='gin')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_embedding_topic_ids', table_name='embedding', schema='core', postgresql_using='gin')
+    op.drop_index('ix_embedding_coverage_years', table_name='embedding', schema='core', postgresql_using='gist')
+    op.drop_index('ix_embedding_country_codes', table_name='embedding', schema='core', postgresql_using='gin')
+    op.drop_column('embedding', 'topic_ids', schema='core')
+    op.drop_column('embedding', 'month_mask', schema='core')
+    op.drop_column('embedding', 'coverage_years', schema='core')
+    op.drop_column('embedding', 'country_codes', schema='core')
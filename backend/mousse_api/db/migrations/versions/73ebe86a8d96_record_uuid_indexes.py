@@ -0,0 +1,27 @@
+"""Record uuid indexes
+
+Revision ID: 73ebe86a8d96
+Revises: fbb5796c88cc
+Create Date: 2026-10-18 11:47:05.215330
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '73ebe86a8d96'
+down_revision = 'fbb5796c88cc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_location_record_uuid', 'location', ['record_uuid'], unique=False, schema='core')
+    op.create_index('ix_record_time_range_record_uuid', 'record_time_range', ['record_uuid'], unique=False, schema='core')
+    op.create_index('ix_embedding_record_uuid', 'embedding', ['record_uuid'], unique=False, schema='core')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_embedding_record_uuid', table_name='embedding', schema='core')
+    op.drop_index('ix_record_time_range_record_uuid', table_name='record_time_range', schema='core')
+    op.drop_index('ix_location_record_uuid', table_name='location', schema='core')
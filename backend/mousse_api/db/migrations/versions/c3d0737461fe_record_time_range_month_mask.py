@@ -0,0 +1,44 @@
+"""Record time range month mask
+
+Revision ID: c3d0737461fe
+Revises: c2cbd721cafd
+Create Date: 2026-10-18 10:12:41.318202
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d0737461fe'
+down_revision = 'c2cbd721cafd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('record_time_range', sa.Column('month_mask', sa.SmallInteger(), server_default='0', nullable=False), schema='core')
+
+    # Backfill the months covered by existing intervals; bit 0 stands for January
+    op.execute("""
+        UPDATE core.record_time_range
+        SET month_mask = CASE
+            WHEN lower_inf(time_interval) OR upper_inf(time_interval)
+                OR upper(time_interval) - lower(time_interval) >= '1 year'::interval THEN 4095
+            ELSE (
+                SELECT COALESCE(bit_or(1 << (EXTRACT(MONTH FROM d)::int - 1)), 0)
+                FROM generate_series(
+                    date_trunc('month', lower(time_interval)),
+                    upper(time_interval),
+                    '1 month'
+                ) AS d
+            )
+        END::smallint
+    """)
+
+    op.create_index('ix_record_time_range_month_mask', 'record_time_range', ['month_mask', 'record_uuid'], unique=False, schema='core')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_record_time_range_month_mask', table_name='record_time_range', schema='core')
+    op.drop_column('record_time_range', 'month_mask', schema='core')
@@ -0,0 +1,38 @@
+"""Country geometry table
+
+Revision ID: fbb5796c88cc
+Revises: c3d0737461fe
+Create Date: 2026-10-18 11:02:17.904512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from geoalchemy2 import Geometry
+
+
+# revision identifiers, used by Alembic.
+revision = 'fbb5796c88cc'
+down_revision = 'c3d0737461fe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('country_geometry',
+    sa.Column('code', sa.VARCHAR(length=3), nullable=False),
+    sa.Column('geometry', Geometry(srid=4326, spatial_index=False, from_text='ST_GeomFromEWKT', name='geometry', nullable=False), nullable=False),
+    sa.PrimaryKeyConstraint('code'),
+    schema='core'
+    )
+    op.create_index('ix_country_geometry_geometry', 'country_geometry', ['geometry'], unique=False, schema='core', postgresql_using='gist')
+
+    op.execute("""
+        INSERT INTO core.country_geometry (code, geometry)
+        SELECT code, ST_MakeValid(ST_Simplify(geometry, 0.1))
+        FROM core.countries
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_country_geometry_geometry', table_name='country_geometry', schema='core', postgresql_using='gist')
+    op.drop_table('country_geometry', schema='core')
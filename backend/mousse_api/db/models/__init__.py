@@ -8,3 +8,4 @@ from .location import Location
 from .embedding import Embedding
 from .countries import Countries
 from .lower_dim import LowerDim
+from .country_geometry import CountryGeometry
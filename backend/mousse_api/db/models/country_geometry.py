@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Index
+from sqlalchemy.dialects.postgresql import VARCHAR
+from geoalchemy2 import Geometry
+
+from mousse_api.db import Base
+
+class CountryGeometry(Base):
+    """Simplified and valid country geometries, precomputed from `core.countries` for filtering."""
+    __tablename__ = "country_geometry"
+
+    code = Column(VARCHAR(3), primary_key=True)
+    geometry = Column(Geometry(geometry_type='GEOMETRY', srid=4326, spatial_index=False), nullable=False)
+
+    __table_args__ = (
+        Index('ix_country_geometry_geometry', 'geometry', postgresql_using='gist'),
+        {"schema": 'core'}
+    )
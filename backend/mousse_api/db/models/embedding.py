@@ -1,6 +1,6 @@
-from sqlalchemy import Column, ForeignKey, Integer, Index
-from sqlalchemy.dialects.postgresql import UUID
-from pgvector.sqlalchemy import Vector
+from sqlalchemy import Column, ForeignKey, Integer, SmallInteger, Index
+from sqlalchemy.dialects.postgresql import UUID, ARRAY, VARCHAR, INT4RANGE
+from mousse_api.db.types import Vector
 
 from mousse_api.db import Base
 
@@ -10,6 +10,11 @@ class Embedding(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     record_uuid = Column(UUID(as_uuid=True), ForeignKey('core.record.uuid', ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
     vector = Column(Vector(1536), nullable=False)
+    # Search filter attributes, denormalized from the location, time range and topic tables
+    country_codes = Column(ARRAY(VARCHAR(3)), nullable=False, server_default='{}')
+    coverage_years = Column(INT4RANGE, nullable=True)
+    month_mask = Column(SmallInteger, nullable=False, server_default='0')
+    topic_ids = Column(ARRAY(Integer), nullable=False, server_default='{}')
 
     __table_args__ = (
         Index(
@@ -18,5 +23,9 @@ class Embedding(Base):
             postgresql_using="diskann",
             postgresql_with={'storage_layout': 'plain', 'search_list_size': 200, 'num_neighbors': 20},
         ),
+        Index('ix_embedding_record_uuid', 'record_uuid'),
+        Index('ix_embedding_country_codes', 'country_codes', postgresql_using='gin'),
+        Index('ix_embedding_coverage_years', 'coverage_years', postgresql_using='gist'),
+        Index('ix_embedding_topic_ids', 'topic_ids', postgresql_using='gin'),
         {"schema": 'core'},
     )
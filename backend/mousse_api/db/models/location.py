@@ -13,5 +13,6 @@ class Location(Base):
 
     __table_args__ = (
         Index('ix_location_geometry', 'geometry', postgresql_using='gist'),
+        Index('ix_location_record_uuid', 'record_uuid'),
         {"schema": 'core'},
     )
@@ -1,6 +1,6 @@
 from sqlalchemy import Column, ForeignKey, Integer, Text
 from sqlalchemy.dialects.postgresql import UUID
-from pgvector.sqlalchemy import Vector
+from mousse_api.db.types import Vector
 
 from mousse_api.db import Base
 
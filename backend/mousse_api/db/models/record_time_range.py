@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, Index
+from sqlalchemy import Column, ForeignKey, Integer, SmallInteger, Index
 from sqlalchemy.dialects.postgresql import UUID, TSTZRANGE
 from uuid import uuid4
 
@@ -10,8 +10,12 @@ class RecordTimeRange(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     record_uuid = Column(UUID(as_uuid=True), ForeignKey('core.record.uuid', ondelete='CASCADE'), nullable=False)
     time_interval = Column(TSTZRANGE, nullable=False)
+    # 12-bit mask of the months (bit 0 for January) covered by the time interval
+    month_mask = Column(SmallInteger, nullable=False, server_default='0')
 
     __table_args__ = (
         Index('ix_record_time_range_time_interval', 'time_interval', postgresql_using='gist'),
+        Index('ix_record_time_range_month_mask', 'month_mask', 'record_uuid'),
+        Index('ix_record_time_range_record_uuid', 'record_uuid'),
         {"schema": 'core'},
     )
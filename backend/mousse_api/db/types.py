@@ -0,0 +1,21 @@
+import numpy as np
+from pgvector.sqlalchemy import VECTOR
+
+class Vector(VECTOR):
+    """
+    pgvector column type for connections using the binary codec of pgvector (see `get_engine`).
+
+    The upstream type binds vectors as text, which the binary codec cannot encode. This one binds
+    them as float32 arrays, which the codec sends as is. Vectors are read as float32 arrays.
+    """
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None:
+                return value
+            value = np.asarray(value, dtype=np.float32)
+            if self.dim is not None and value.shape != (self.dim,):
+                raise ValueError('expected %d dimensions, not %s' % (self.dim, value.shape))
+            return value
+        return process
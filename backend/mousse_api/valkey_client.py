@@ -1,9 +1,164 @@
-import valkey
+import os
+import time
+import asyncio
+from functools import lru_cache
+import valkey.asyncio
+from typing import Any, Awaitable, Callable
+from valkey.exceptions import ConnectionError, TimeoutError
 
-def get_valkey_client():
-    return valkey.Valkey(
-        host="cache",
-        port=6379,
+from mousse_api.logger import logger
+from mousse_api.api.utils import metrics
+
+breaker_open_metric = metrics.counter("cache_circuit_open", "Number of times the cache circuit breaker opened")
+breaker_rejected_metric = metrics.counter("cache_circuit_rejected", "Number of cache commands rejected while the circuit breaker was open")
+pool_exhausted_metric = metrics.counter("cache_pool_exhausted", "Number of cache commands that found no free connection in time")
+
+class CacheUnavailableError(ConnectionError):
+    """Raised without contacting Valkey while the circuit breaker is open."""
+
+class PoolExhaustedError(ConnectionError):
+    """Raised when no connection of the pool became free in time, which says nothing about the health of Valkey."""
+
+class WaitingConnectionPool(valkey.asyncio.BlockingConnectionPool):
+    """Blocking connection pool telling the wait for a free connection apart from a failure to connect."""
+
+    async def get_connection(self, command_name, *keys, **options):
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        except ConnectionError as e:
+            # The pool raises a ConnectionError when the wait for a free connection times out
+            if isinstance(e.__cause__, asyncio.TimeoutError):
+                pool_exhausted_metric.inc()
+                raise PoolExhaustedError("No cache connection available") from e
+            raise
+
+class CircuitBreaker:
+    """
+    Stops calling the cache after repeated connection failures.
+
+    After `threshold` consecutive failures the circuit opens, and every call is rejected
+    immediately for `cooldown` seconds. After that, calls go through again; the circuit
+    closes on the first success and opens again on the first failure.
+
+    Attributes:
+        threshold (int): Number of consecutive failures that opens the circuit.
+        cooldown (float): Time (in seconds) the circuit stays open.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    def check(self) -> None:
+        """
+        Raises:
+            CacheUnavailableError: If the circuit is open.
+        """
+        if self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown:
+            breaker_rejected_metric.inc()
+            raise CacheUnavailableError("Cache circuit breaker is open")
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    async def call(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Calls the cache through the circuit breaker, recording the outcome of the call.
+
+        Raises:
+            CacheUnavailableError: If the circuit is open.
+        """
+        self.check()
+        try:
+            result = await fn(*args, **kwargs)
+        except PoolExhaustedError:
+            raise
+        except (ConnectionError, TimeoutError):
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                logger.warning("Cache unavailable after %d failures, bypassing it for %.0fs", self.failures, self.cooldown)
+                breaker_open_metric.inc()
+            self.opened_at = time.monotonic()
+
+class BreakingValkey(valkey.asyncio.Valkey):
+    """
+    Asynchronous Valkey client guarded by a circuit breaker.
+
+    Running out of free connections of the pool is not counted as a failure, as it happens with a
+    healthy server under a burst of requests.
+    """
+
+    def __init__(self, *args, breaker: CircuitBreaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute_command(self, *args, **options):
+        return await self.breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> "BreakingPipeline":
+        return BreakingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint, breaker=self.breaker)
+
+class BreakingPipeline(valkey.asyncio.client.Pipeline):
+    """Pipeline of a `BreakingValkey` client, guarded by its circuit breaker like a single command."""
+
+    def __init__(self, *args, breaker: CircuitBreaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    async def execute(self, raise_on_error: bool = True):
+        return await self.breaker.call(super().execute, raise_on_error)
+
+@lru_cache(maxsize=None)
+def get_valkey_client() -> BreakingValkey:
+    """
+    Creates and caches the process-wide asynchronous Valkey client.
+
+    The client returns raw bytes and shares a bounded connection pool among all the callers.
+    Every command is bounded by a socket timeout, and the cache is bypassed for a while
+    (raising `CacheUnavailableError`) after repeated connection failures. A command waiting
+    too long for a free connection raises `PoolExhaustedError`, without opening the circuit.
+
+    Environment Variables:
+        - CACHE_URL: The address (host:port) of the Valkey server (default: cache:6379).
+        - CACHE_MAX_CONNECTIONS: Maximum number of connections of the pool (default: 50).
+        - CACHE_TIMEOUT: Timeout of a command in seconds (default: 0.5).
+        - CACHE_CONNECT_TIMEOUT: Timeout for establishing a connection in seconds (default: 0.5).
+        - CACHE_POOL_TIMEOUT: Time to wait for a free connection of the pool in seconds (default: 1).
+        - CACHE_BREAKER_THRESHOLD: Consecutive failures that open the circuit breaker (default: 5).
+        - CACHE_BREAKER_COOLDOWN: Time the circuit breaker stays open in seconds (default: 30).
+
+    Returns:
+        BreakingValkey: The Valkey client instance.
+    """
+    host, _, port = os.getenv("CACHE_URL", "cache:6379").partition(":")
+    pool = WaitingConnectionPool(
+        host=host,
+        port=int(port or 6379),
         db=0,
-        decode_responses=True  # Makes `get()` return strings instead of bytes
+        max_connections=int(os.getenv("CACHE_MAX_CONNECTIONS", 50)),
+        timeout=float(os.getenv("CACHE_POOL_TIMEOUT", 1)),
+        socket_timeout=float(os.getenv("CACHE_TIMEOUT", 0.5)),
+        socket_connect_timeout=float(os.getenv("CACHE_CONNECT_TIMEOUT", 0.5)),
+        health_check_interval=30,
+    )
+    breaker = CircuitBreaker(
+        threshold=int(os.getenv("CACHE_BREAKER_THRESHOLD", 5)),
+        cooldown=float(os.getenv("CACHE_BREAKER_COOLDOWN", 30)),
     )
+    return BreakingValkey(connection_pool=pool, breaker=breaker)
+
+async def close_valkey_client() -> None:
+    """Closes the process-wide Valkey client and its connection pool, if it has been created."""
+    if get_valkey_client.cache_info().currsize > 0:
+        await get_valkey_client().aclose(close_connection_pool=True)
+        get_valkey_client.cache_clear()
@@ -0,0 +1,138 @@
+"""
+Export gte-Qwen2-1.5B-instruct to ONNX with dynamic int8 quantization,
+and check the parity of the quantized model with the reference one.
+
+Usage (inside the triton container, with this directory mounted on /workspace):
+
+    python /workspace/export_onnx.py export
+    python /workspace/export_onnx.py check --min-similarity 0.98
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer, AutoModel
+
+REFERENCE_ENGINE = "/engines/gte-Qwen2-1.5B-instruct"
+QUANTIZED_ENGINE = "/engines/gte-Qwen2-1.5B-instruct-int8"
+
+PARITY_QUERIES = [
+    "Air pollution",
+    "Air pollution in Rome last summer",
+    "Sea surface temperature anomalies in the Mediterranean",
+    "Land cover classification from Sentinel-2 imagery",
+    "Daily precipitation records for alpine weather stations",
+    "Lithology of sediment cores",
+    "Groundwater levels in agricultural areas",
+    "Forest fire burned area maps",
+    "Ocean salinity profiles from Argo floats",
+    "Urban heat island",
+    "soil moisture",
+    "CO2 emissions of power plants in Germany between 2010 and 2015",
+]
+
+class Encoder(torch.nn.Module):
+    """Wraps the HuggingFace model, exposing only the last hidden state."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, use_cache=False).last_hidden_state
+
+def get_instruct(query: str) -> str:
+    return f'Instruct: {os.getenv("TASK_DESCRIPTION")}\nQuery: {query}'
+
+def last_token_pool(last_hidden_states: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    left_padding = (attention_mask[:, -1].sum() == attention_mask.shape[0])
+    if left_padding:
+        return last_hidden_states[:, -1]
+    sequence_lengths = attention_mask.sum(axis=1) - 1
+    return last_hidden_states[np.arange(last_hidden_states.shape[0]), sequence_lengths]
+
+def export(args) -> None:
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(args.output, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(args.reference, trust_remote_code=True)
+    model = AutoModel.from_pretrained(args.reference, trust_remote_code=True, attn_implementation="eager")
+    model.eval()
+
+    sample = tokenizer([get_instruct(q) for q in PARITY_QUERIES[:2]], padding=True, return_tensors='pt')
+    fp32_path = os.path.join(args.output, "model_fp32.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            Encoder(model),
+            (sample['input_ids'], sample['attention_mask']),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=17,
+        )
+
+    quantize_dynamic(
+        fp32_path,
+        os.path.join(args.output, "model_int8.onnx"),
+        op_types_to_quantize=["MatMul"],
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+        use_external_data_format=True,
+    )
+    tokenizer.save_pretrained(args.output)
+    print(f"Quantized model written to {args.output}")
+
+def check(args) -> None:
+    import onnxruntime as ort
+
+    texts = [get_instruct(q) for q in PARITY_QUERIES]
+
+    tokenizer = AutoTokenizer.from_pretrained(args.reference, trust_remote_code=True)
+    model = AutoModel.from_pretrained(args.reference, trust_remote_code=True)
+    model.eval()
+    batch_dict = tokenizer(texts, padding=True, truncation=True, return_tensors='pt')
+    with torch.no_grad():
+        outputs = model(**batch_dict)
+    reference = last_token_pool(outputs.last_hidden_state.numpy(), batch_dict['attention_mask'].numpy())
+    reference = F.normalize(torch.from_numpy(reference), p=2, dim=1).numpy()
+
+    session = ort.InferenceSession(os.path.join(args.output, "model_int8.onnx"), providers=["CPUExecutionProvider"])
+    batch_dict = tokenizer(texts, padding=True, truncation=True, return_tensors='np')
+    attention_mask = batch_dict['attention_mask'].astype(np.int64)
+    last_hidden_state, = session.run(
+        ["last_hidden_state"],
+        {"input_ids": batch_dict['input_ids'].astype(np.int64), "attention_mask": attention_mask},
+    )
+    quantized = last_token_pool(last_hidden_state, attention_mask)
+    quantized = quantized / np.linalg.norm(quantized, axis=1, keepdims=True)
+
+    similarities = (reference * quantized).sum(axis=1)
+    for query, similarity in zip(PARITY_QUERIES, similarities):
+        print(f"{similarity:.4f}  {query}")
+    print(f"min={similarities.min():.4f} mean={similarities.mean():.4f}")
+
+    if similarities.min() < args.min_similarity:
+        print(f"Parity check failed: cosine similarity below {args.min_similarity}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reference', default=REFERENCE_ENGINE, help="Path to the reference HuggingFace model")
+    parser.add_argument('--output', default=QUANTIZED_ENGINE, help="Path to the quantized model")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('export', help="Export and quantize the reference model")
+    check_parser = subparsers.add_parser('check', help="Compare the quantized model with the reference one")
+    check_parser.add_argument('--min-similarity', type=float, default=0.98, help="Minimum accepted cosine similarity per query")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(args)
+    else:
+        check(args)
@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+import onnxruntime as ort
+from transformers import AutoTokenizer
+import triton_python_backend_utils as pb_utils
+
+def read_parameter_as_type(value, name, pytype=str):
+    if value == "":
+        return None
+    if value.startswith("${") and value.endswith("}"):
+        value = os.getenv(value[2:-1].upper())
+    if pytype is bool:
+        return value.lower() in ["1", "true"]
+    try:
+        result = pytype(value)
+        return result
+    except:
+        pb_utils.Logger.log_warning(
+            f"Could not read parameter '{name}' with value '{value}', will use default."
+        )
+        return None
+
+
+def get_parameter(model_config, name, default=None, pytype=str):
+    if name not in model_config['parameters']:
+        return None
+    value = read_parameter_as_type(
+        model_config['parameters'][name]['string_value'], name, pytype)
+    return value if value is not None else default
+
+class TritonPythonModel:
+    """
+    CPU-optimized variant of the gte-Qwen2-1.5B-instruct embedding model.
+
+    Runs the encoder exported to ONNX with dynamic int8 quantization (see `triton/export_onnx.py`)
+    on ONNX Runtime, keeping the `TEXT` -> `EMBEDDINGS` contract and the last-token pooling of the
+    reference model.
+    """
+
+    def initialize(self, args):
+        model_config = json.loads(args['model_config'])
+        model_engine = "/engines/gte-Qwen2-1.5B-instruct-int8"
+        self.tokenizer = AutoTokenizer.from_pretrained(model_engine, trust_remote_code=True)
+        self.max_length = get_parameter(model_config, "max_length", default=8192, pytype=int)
+        self.task_description = get_parameter(model_config, "task_description")
+        self.bucket_size = get_parameter(model_config, "bucket_size", default=8, pytype=int)
+        num_threads = get_parameter(model_config, "num_threads", default=0, pytype=int)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            os.path.join(model_engine, "model_int8.onnx"),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+
+    def last_token_pool(self, last_hidden_states: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        left_padding = (attention_mask[:, -1].sum() == attention_mask.shape[0])
+        if left_padding:
+            return last_hidden_states[:, -1]
+        else:
+            sequence_lengths = attention_mask.sum(axis=1) - 1
+            batch_size = last_hidden_states.shape[0]
+            return last_hidden_states[np.arange(batch_size), sequence_lengths]
+
+    def get_instruct(self, query: str) -> str:
+        return f'Instruct: {self.task_description}\nQuery: {query}'
+
+    def embed(self, input_texts: list[str]) -> np.ndarray:
+        """
+        Embeds a list of texts, padding them in buckets of similar length.
+
+        Texts are sorted by their tokenized length and split into buckets of at most
+        `bucket_size` texts, so that each forward pass pads only to the longest text
+        of its bucket. The embeddings are returned in the order of the input texts.
+        """
+        encoded = self.tokenizer(input_texts, max_length=self.max_length, truncation=True)
+        lengths = np.array([len(ids) for ids in encoded['input_ids']])
+        order = np.argsort(lengths, kind='stable')
+
+        embeddings_np = None
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            batch_dict = self.tokenizer.pad(
+                {
+                    'input_ids': [encoded['input_ids'][i] for i in bucket],
+                    'attention_mask': [encoded['attention_mask'][i] for i in bucket],
+                },
+                padding=True,
+                return_tensors='np'
+            )
+
+            attention_mask = batch_dict['attention_mask'].astype(np.int64)
+            last_hidden_state, = self.session.run(
+                ["last_hidden_state"],
+                {"input_ids": batch_dict['input_ids'].astype(np.int64), "attention_mask": attention_mask},
+            )
+            embeddings = self.last_token_pool(last_hidden_state, attention_mask).astype(np.float32)
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+            if embeddings_np is None:
+                embeddings_np = np.empty((len(input_texts), embeddings.shape[1]), dtype=np.float32)
+            embeddings_np[bucket] = embeddings
+        return embeddings_np
+
+    def execute(self, requests):
+        # Merge the texts of all the scheduled requests into a single batch
+        input_texts = []
+        counts = []
+        for request in requests:
+            texts = pb_utils.get_input_tensor_by_name(request, "TEXT").as_numpy()
+            input_texts.extend(self.get_instruct(text[0].decode('utf-8')) for text in texts)
+            counts.append(len(texts))
+
+        try:
+            embeddings_np = self.embed(input_texts)
+        except Exception as e:
+            error = pb_utils.TritonError(f"Embedding failed: {e}")
+            return [pb_utils.InferenceResponse(output_tensors=[], error=error) for _ in requests]
+
+        # Scatter the embeddings back to the requests they originate from
+        responses = []
+        offsets = np.cumsum([0] + counts)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            embeddings_tensor = pb_utils.Tensor("EMBEDDINGS", embeddings_np[start:end])
+            responses.append(pb_utils.InferenceResponse(output_tensors=[embeddings_tensor]))
+        return responses
+
+    def finalize(self):
+        print('Cleaning up...')
+        self.session = None
+        self.tokenizer = None
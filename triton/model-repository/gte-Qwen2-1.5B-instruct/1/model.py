@@ -1,5 +1,6 @@
 import os
 import json
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import Tensor
@@ -38,6 +39,7 @@ class TritonPythonModel:
         self.tokenizer = AutoTokenizer.from_pretrained(model_engine, trust_remote_code=True)
         self.max_length = get_parameter(model_config, "max_length", default=8192, pytype=int)
         self.task_description = get_parameter(model_config, "task_description")
+        self.bucket_size = get_parameter(model_config, "bucket_size", default=8, pytype=int)
         self.model = AutoModel.from_pretrained(model_engine, trust_remote_code=True)
         self.model.eval()
 
@@ -53,17 +55,27 @@ class TritonPythonModel:
     def get_instruct(self, query: str) -> str:
         return f'Instruct: {self.task_description}\nQuery: {query}'
 
-    def execute(self, requests):
-        responses = []
-        for request in requests:
-            input_texts = pb_utils.get_input_tensor_by_name(request, "TEXT").as_numpy()
-            input_texts = [self.get_instruct(text[0].decode('utf-8')) for text in input_texts]
+    def embed(self, input_texts: list[str]) -> np.ndarray:
+        """
+        Embeds a list of texts, padding them in buckets of similar length.
 
-            batch_dict = self.tokenizer(
-                input_texts,
-                max_length=self.max_length,
+        Texts are sorted by their tokenized length and split into buckets of at most
+        `bucket_size` texts, so that each forward pass pads only to the longest text
+        of its bucket. The embeddings are returned in the order of the input texts.
+        """
+        encoded = self.tokenizer(input_texts, max_length=self.max_length, truncation=True)
+        lengths = np.array([len(ids) for ids in encoded['input_ids']])
+        order = np.argsort(lengths, kind='stable')
+
+        embeddings_np = None
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            batch_dict = self.tokenizer.pad(
+                {
+                    'input_ids': [encoded['input_ids'][i] for i in bucket],
+                    'attention_mask': [encoded['attention_mask'][i] for i in bucket],
+                },
                 padding=True,
-                truncation=True,
                 return_tensors='pt'
             )
 
@@ -71,8 +83,33 @@ class TritonPythonModel:
                 outputs = self.model(**batch_dict)
                 embeddings = self.last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
                 embeddings = F.normalize(embeddings, p=2, dim=1)
-            embeddings_np = embeddings.cpu().numpy()
-            embeddings_tensor = pb_utils.Tensor("EMBEDDINGS", embeddings_np)
+            embeddings = embeddings.cpu().numpy()
+
+            if embeddings_np is None:
+                embeddings_np = np.empty((len(input_texts), embeddings.shape[1]), dtype=embeddings.dtype)
+            embeddings_np[bucket] = embeddings
+        return embeddings_np
+
+    def execute(self, requests):
+        # Merge the texts of all the scheduled requests into a single batch
+        input_texts = []
+        counts = []
+        for request in requests:
+            texts = pb_utils.get_input_tensor_by_name(request, "TEXT").as_numpy()
+            input_texts.extend(self.get_instruct(text[0].decode('utf-8')) for text in texts)
+            counts.append(len(texts))
+
+        try:
+            embeddings_np = self.embed(input_texts)
+        except Exception as e:
+            error = pb_utils.TritonError(f"Embedding failed: {e}")
+            return [pb_utils.InferenceResponse(output_tensors=[], error=error) for _ in requests]
+
+        # Scatter the embeddings back to the requests they originate from
+        responses = []
+        offsets = np.cumsum([0] + counts)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            embeddings_tensor = pb_utils.Tensor("EMBEDDINGS", embeddings_np[start:end])
             responses.append(pb_utils.InferenceResponse(output_tensors=[embeddings_tensor]))
         return responses
 